@@ -0,0 +1,51 @@
+"""add membership id sequence
+
+Revision ID: 5d2f7a9c1e38
+Revises: 8e4b6d0c5a17
+Create Date: 2026-10-19 12:41:07.534211
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5d2f7a9c1e38'
+down_revision: Union[str, None] = '8e4b6d0c5a17'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+NEXT_MEMBERSHIP_ID = """
+CREATE OR REPLACE FUNCTION next_membership_id() RETURNS varchar(9) AS $$
+DECLARE
+    alphabet CONSTANT text := '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ';
+    n bigint;
+    suffix text;
+BEGIN
+    LOOP
+        n := nextval('membership_id_seq');
+        suffix := '';
+        FOR i IN 1..5 LOOP
+            suffix := substr(alphabet, CAST(mod(n, 36) AS int) + 1, 1) || suffix;
+            n := n / 36;
+        END LOOP;
+        EXIT WHEN NOT EXISTS (SELECT 1 FROM memberships WHERE id = 'GSR-' || suffix);
+    END LOOP;
+    RETURN 'GSR-' || suffix;
+END
+$$ LANGUAGE plpgsql
+"""
+
+
+def upgrade() -> None:
+    op.execute("CREATE SEQUENCE IF NOT EXISTS membership_id_seq MINVALUE 0 MAXVALUE 60466175 START 0 NO CYCLE")
+    op.execute(NEXT_MEMBERSHIP_ID)
+    op.alter_column("memberships", "id", existing_type=sa.String(length=9), server_default=sa.text("next_membership_id()"))
+
+
+def downgrade() -> None:
+    op.alter_column("memberships", "id", existing_type=sa.String(length=9), server_default=None)
+    op.execute("DROP FUNCTION IF EXISTS next_membership_id()")
+    op.execute("DROP SEQUENCE IF EXISTS membership_id_seq")
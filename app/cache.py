@@ -0,0 +1,306 @@
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from sqlalchemy import delete, select, text
+from sqlalchemy.dialects.postgresql import insert
+from app.config import config
+import asyncio
+import contextlib
+import hashlib
+import mmap
+import os
+import pickle
+import stat
+import struct
+import tempfile
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # Windows, only the file backend needs it
+    fcntl = None
+
+MISSING = object()
+
+
+class TTLCache:
+    # Small in-process LRU cache whose entries expire after `ttl` seconds
+    def __init__(self, maxsize: int = 10000, ttl: float = 300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=MISSING):
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is None:
+                return default
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self.data[key]
+                return default
+            self.data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.data[key] = (value, time.monotonic() + self.ttl)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def clear(self, predicate=None):
+        with self.lock:
+            if predicate is None:
+                self.data.clear()
+                return
+            for key in [key for key in self.data if predicate(key)]:
+                del self.data[key]
+
+    def __len__(self):
+        return len(self.data)
+
+
+class SharedCache:
+    # Cache shared by every worker, a key missing everywhere is computed by one caller while the others wait for its result
+    async def get_or_compute(self, key: str, compute, ttl: float, refresh: bool = False):
+        requested_at = time.time()
+        if not refresh:
+            entry = await self.get_entry(key)
+            if entry is not None:
+                return entry[0]
+
+        async with self.lock(key):
+            # Whoever held the lock before us may have stored a fresh value in the meantime
+            entry = await self.get_entry(key)
+            if entry is not None and (not refresh or entry[1] >= requested_at):
+                return entry[0]
+            value = await compute()
+            await self.set(key, value, ttl)
+            return value
+
+    async def get(self, key: str, default=MISSING):
+        entry = await self.get_entry(key)
+        return default if entry is None else entry[0]
+
+
+class KeyLocks:
+    # One asyncio lock per key, so a process queues its own callers before any cross-process lock is taken
+    def __init__(self):
+        self.locks = {}
+
+    @asynccontextmanager
+    async def __call__(self, key: str):
+        lock = self.locks.setdefault(key, asyncio.Lock())
+        try:
+            async with lock:
+                yield
+        finally:
+            if not lock.locked() and self.locks.get(key) is lock:
+                del self.locks[key]
+
+
+class MemoryCache(SharedCache):
+    # Per-process only, for a single worker or development
+    def __init__(self):
+        self.data = {}
+        self.lock = KeyLocks()
+
+    async def get_entry(self, key: str):
+        entry = self.data.get(key)
+        if entry is None:
+            return None
+        value, stored_at, expires_at = entry
+        if expires_at < time.time():
+            self.data.pop(key, None)
+            return None
+        return value, stored_at
+
+    async def set(self, key: str, value, ttl: float):
+        now = time.time()
+        self.data[key] = (value, now, now + ttl)
+
+    async def delete(self, key: str):
+        self.data.pop(key, None)
+
+    async def clear(self):
+        self.data.clear()
+
+
+class FileCache(SharedCache):
+    # One pickle per key, shared by the workers of a host. Under /dev/shm the files live in shared memory.
+    # Entries start with their stored/expiry times so an expired entry is dropped without unpickling it.
+    HEADER = struct.Struct("dd")
+    # Keys share 256 lock files (first two hex digits of their hash) instead of leaving one lock file behind per key.
+    # Callers must not nest get_or_compute, a second key of the same bucket would wait on the lock already held.
+    LOCK_BUCKET_DIGITS = 2
+    SWEEP_INTERVAL = 60
+    TEMPORARY_PREFIX = "tmp-"
+    TEMPORARY_MAX_AGE = 3600
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.process_locks = KeyLocks()
+        self.swept_at = 0.0
+        # Entries are unpickled, so only a private directory of this user is trusted: a directory another user
+        # created first (/dev/shm is world-writable) could hand every worker a crafted pickle
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        status = os.lstat(directory)
+        if not stat.S_ISDIR(status.st_mode) or status.st_uid != os.getuid() or stat.S_IMODE(status.st_mode) & 0o077:
+            raise ValueError(f"SHARED_CACHE_DIR {directory} must be a directory owned by this user with mode 0700")
+
+    def path(self, key: str):
+        return os.path.join(self.directory, hashlib.sha256(key.encode()).hexdigest())
+
+    def lock_path(self, key: str):
+        return os.path.join(self.directory, hashlib.sha256(key.encode()).hexdigest()[: self.LOCK_BUCKET_DIGITS] + ".lock")
+
+    def read(self, path: str):
+        try:
+            with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                stored_at, expires_at = self.HEADER.unpack_from(data)
+                if expires_at < time.time():
+                    os.remove(path)
+                    return None
+                return pickle.loads(data[self.HEADER.size :]), stored_at
+        except (FileNotFoundError, ValueError):
+            # ValueError: another process removed or truncated the file while it was being mapped
+            return None
+
+    def write(self, path: str, value, ttl: float):
+        now = time.time()
+        # Written aside and renamed so readers never see a partial entry
+        fd, temporary_path = tempfile.mkstemp(dir=self.directory, prefix=self.TEMPORARY_PREFIX)
+        with os.fdopen(fd, "wb") as f:
+            f.write(self.HEADER.pack(now, now + ttl))
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary_path, path)
+
+        if now - self.swept_at >= self.SWEEP_INTERVAL:
+            self.swept_at = now
+            self.sweep(now)
+
+    def sweep(self, now: float):
+        # Expired entries are otherwise only dropped when their key is read again, and the RFM keys change with every
+        # date window. Only the header is read, temporary files left by a crashed writer go once they are old enough.
+        for entry in os.scandir(self.directory):
+            try:
+                if entry.name.startswith(self.TEMPORARY_PREFIX):
+                    if entry.stat().st_mtime < now - self.TEMPORARY_MAX_AGE:
+                        os.remove(entry.path)
+                elif not entry.name.endswith(".lock"):
+                    with open(entry.path, "rb") as f:
+                        header = f.read(self.HEADER.size)
+                    if len(header) == self.HEADER.size and self.HEADER.unpack(header)[1] < now:
+                        os.remove(entry.path)
+            except FileNotFoundError:
+                # Removed or replaced by another worker in the meantime
+                pass
+
+    async def get_entry(self, key: str):
+        return await asyncio.to_thread(self.read, self.path(key))
+
+    async def set(self, key: str, value, ttl: float):
+        await asyncio.to_thread(self.write, self.path(key), value, ttl)
+
+    async def delete(self, key: str):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.path(key))
+
+    async def clear(self):
+        for name in os.listdir(self.directory):
+            if not name.endswith(".lock"):
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(os.path.join(self.directory, name))
+
+    @asynccontextmanager
+    async def lock(self, key: str):
+        async with self.process_locks(key):
+            # flock is released by the OS if the holder dies, so a crashed worker never leaves the key locked
+            lock_file = open(self.lock_path(key), "a")
+            try:
+                await asyncio.to_thread(fcntl.flock, lock_file, fcntl.LOCK_EX)
+                yield
+            finally:
+                lock_file.close()
+
+
+class PostgresCache(SharedCache):
+    # Shared by every worker on every host through the shared_cache table, locked with advisory locks
+    def __init__(self, engine):
+        self.engine = engine
+        self.process_locks = KeyLocks()
+
+    async def get_entry(self, key: str):
+        from app.models import SharedCacheEntry
+
+        async with self.engine.connect() as conn:
+            result = await conn.execute(
+                select(SharedCacheEntry.value, SharedCacheEntry.stored_at).where(SharedCacheEntry.key == key, SharedCacheEntry.expires_at > datetime.now())
+            )
+            row = result.first()
+        if row is None:
+            return None
+        return await asyncio.to_thread(pickle.loads, row.value), row.stored_at.timestamp()
+
+    async def set(self, key: str, value, ttl: float):
+        from app.models import SharedCacheEntry
+
+        data = await asyncio.to_thread(pickle.dumps, value, pickle.HIGHEST_PROTOCOL)
+        now = datetime.now()
+        expires_at = now + timedelta(seconds=ttl)
+        async with self.engine.begin() as conn:
+            await conn.execute(delete(SharedCacheEntry).where(SharedCacheEntry.expires_at <= now))
+            await conn.execute(
+                insert(SharedCacheEntry)
+                .values(key=key, value=data, stored_at=now, expires_at=expires_at)
+                .on_conflict_do_update(index_elements=[SharedCacheEntry.key], set_={"value": data, "stored_at": now, "expires_at": expires_at})
+            )
+
+    async def delete(self, key: str):
+        from app.models import SharedCacheEntry
+
+        async with self.engine.begin() as conn:
+            await conn.execute(delete(SharedCacheEntry).where(SharedCacheEntry.key == key))
+
+    async def clear(self):
+        from app.models import SharedCacheEntry
+
+        async with self.engine.begin() as conn:
+            await conn.execute(delete(SharedCacheEntry))
+
+    @asynccontextmanager
+    async def lock(self, key: str):
+        async with self.process_locks(key):
+            # Session-level advisory lock, dropped by the server if the holding connection goes away
+            async with self.engine.connect() as conn:
+                await conn.execute(text("SELECT pg_advisory_lock(hashtext(:key))"), {"key": key})
+                await conn.commit()
+                try:
+                    yield
+                finally:
+                    await conn.execute(text("SELECT pg_advisory_unlock(hashtext(:key))"), {"key": key})
+                    await conn.commit()
+
+
+def create_shared_cache(backend: str):
+    if backend == "file" and fcntl is None:
+        # file is the default, a platform without POSIX file locks (Windows) still has to start
+        print("SHARED_CACHE_BACKEND=file needs POSIX file locks, falling back to the per-process memory cache")
+        backend = "memory"
+    if backend == "memory":
+        return MemoryCache()
+    if backend == "file":
+        return FileCache(config.shared_cache_dir)
+    if backend == "postgres":
+        from app.db import async_engine
+
+        return PostgresCache(async_engine)
+    raise ValueError(f"Unknown SHARED_CACHE_BACKEND {backend!r}, use memory, file or postgres")
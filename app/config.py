@@ -1,5 +1,7 @@
 from pydantic_settings import BaseSettings
 import os
+import secrets
+import tempfile
 
 
 class Config(BaseSettings):
@@ -10,6 +12,47 @@ class Config(BaseSettings):
     db_name: str = os.getenv("DB_NAME")
     model_directory: str = os.getenv("MODEL_DIRECTORY", "models")
     model_version: str = os.getenv("MODEL_VERSION", "v1")
+    segment_cache_size: int = int(os.getenv("SEGMENT_CACHE_SIZE", 100000))
+    segment_cache_ttl: int = int(os.getenv("SEGMENT_CACHE_TTL", 300))
+    ml_enabled: bool = os.getenv("ML_ENABLED", "true").lower() == "true"
+    online_scoring: bool = os.getenv("ONLINE_SCORING", "false").lower() == "true"
+    resegment_scheduler: bool = os.getenv("RESEGMENT_SCHEDULER", "false").lower() == "true"
+    resegment_check_interval: int = int(os.getenv("RESEGMENT_CHECK_INTERVAL", 900))
+    resegment_max_age: int = int(os.getenv("RESEGMENT_MAX_AGE", 86400))
+    resegment_volume_threshold: float = float(os.getenv("RESEGMENT_VOLUME_THRESHOLD", 0.1))
+    resegment_drift_threshold: float = float(os.getenv("RESEGMENT_DRIFT_THRESHOLD", 0.25))
+    password_hash_concurrency: int = int(os.getenv("PASSWORD_HASH_CONCURRENCY", os.cpu_count() or 1))
+    secret_key: str = os.getenv("SECRET_KEY", "")
+    secret_key_generated: bool = False
+    access_token_ttl: int = int(os.getenv("ACCESS_TOKEN_TTL", 3600))
+    token_cache_size: int = int(os.getenv("TOKEN_CACHE_SIZE", 100000))
+    catalog_cache_size: int = int(os.getenv("CATALOG_CACHE_SIZE", 1024))
+    catalog_cache_ttl: int = int(os.getenv("CATALOG_CACHE_TTL", 60))
+    db_echo: bool = os.getenv("DB_ECHO", "false").lower() == "true"
+    slow_query_threshold_ms: float = float(os.getenv("SLOW_QUERY_THRESHOLD_MS", 200))
+    slow_query_explain: bool = os.getenv("SLOW_QUERY_EXPLAIN", "false").lower() == "true"
+    slow_query_parameters: bool = os.getenv("SLOW_QUERY_PARAMETERS", "false").lower() == "true"
+    query_diagnostics: bool = os.getenv("QUERY_DIAGNOSTICS", "false").lower() == "true"
+    n_plus_one_threshold: int = int(os.getenv("N_PLUS_ONE_THRESHOLD", 10))
+    startup_schema: str = os.getenv("STARTUP_SCHEMA", "create_all")
+    db_connect_retries: int = int(os.getenv("DB_CONNECT_RETRIES", 5))
+    db_connect_backoff: float = float(os.getenv("DB_CONNECT_BACKOFF", 0.1))
+    db_connect_backoff_max: float = float(os.getenv("DB_CONNECT_BACKOFF_MAX", 5))
+    db_pool_warm: int = int(os.getenv("DB_POOL_WARM", 5))
+    shared_cache_backend: str = os.getenv("SHARED_CACHE_BACKEND", "file")
+    shared_cache_dir: str = os.getenv(
+        "SHARED_CACHE_DIR",
+        os.path.join(
+            "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir(),
+            f"customer-segmentation-cache-{os.getuid()}" if hasattr(os, "getuid") else "customer-segmentation-cache",
+        ),
+    )
+    rfm_cache_ttl: int = int(os.getenv("RFM_CACHE_TTL", 900))
+    dashboard_cache_ttl: int = int(os.getenv("DASHBOARD_CACHE_TTL", 60))
+    read_database_url: str = os.getenv("READ_DATABASE_URL", "")
+    replica_max_lag: float = float(os.getenv("REPLICA_MAX_LAG", 5))
+    replica_lag_check_interval: float = float(os.getenv("REPLICA_LAG_CHECK_INTERVAL", 5))
+    metrics_enabled: bool = os.getenv("METRICS_ENABLED", "true").lower() == "true"
     DATABASE_URL: str = f"postgresql+asyncpg://{db_user}:{db_password}@{db_host}:{db_port}/{db_name}"
     MODEL_PATH: str = f"{model_directory}/{model_version}"
 
@@ -17,5 +60,11 @@ class Config(BaseSettings):
         extra = "allow"
         env_file = ".env"
 
+    def model_post_init(self, __context):
+        # SECRET_KEY may come from the environment or .env, only a missing one is replaced by a random per-process key
+        if not self.secret_key:
+            self.secret_key = secrets.token_urlsafe(32)
+            self.secret_key_generated = True
+
 
 config = Config()
@@ -1,11 +1,17 @@
+from sqlalchemy import text
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import sessionmaker
 from app.models import Base
 from app.config import config
 import asyncio
+import os
+import random
+import time
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
 DATABASE_URL = config.DATABASE_URL
-async_engine = create_async_engine(DATABASE_URL, echo=True)
+async_engine = create_async_engine(DATABASE_URL, echo=config.db_echo)
 SessionLocal = sessionmaker(
     bind=async_engine,
     class_=AsyncSession,
@@ -13,6 +19,58 @@ SessionLocal = sessionmaker(
 )
 
 
+# Optional read replica for dashboard, listing and export reads. A short connect timeout keeps a dead replica from stalling the lag check.
+REPLICA_CONNECT_TIMEOUT = 2
+read_engine = (
+    create_async_engine(config.read_database_url, echo=config.db_echo, connect_args={"timeout": REPLICA_CONNECT_TIMEOUT})
+    if config.read_database_url
+    else None
+)
+ReadSessionLocal = sessionmaker(bind=read_engine, class_=AsyncSession, expire_on_commit=False) if read_engine is not None else None
+
+# Seconds the replica is behind, 0 when it has replayed everything it received or is not in recovery at all
+REPLICA_LAG_QUERY = text(
+    "SELECT CASE WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+    "ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END"
+)
+
+
+class ReplicaMonitor:
+    # Replica lag measured at most every REPLICA_LAG_CHECK_INTERVAL seconds, reads go to the primary while it is too far behind or down
+    def __init__(self, engine):
+        self.engine = engine
+        self.lag = None
+        self.usable = False
+        self.checked_at = None
+        self.lock = asyncio.Lock()
+
+    async def check(self):
+        try:
+            async with self.engine.connect() as conn:
+                self.lag = float((await conn.execute(REPLICA_LAG_QUERY)).scalar() or 0)
+            usable = self.lag <= config.replica_max_lag
+            reason = f"lag {self.lag:.1f}s"
+        except Exception as e:
+            self.lag = None
+            usable = False
+            reason = str(e)
+        if usable != self.usable or self.checked_at is None:
+            print(f"Read replica {'in use' if usable else 'bypassed, reading from the primary'} ({reason})")
+        self.usable = usable
+        self.checked_at = time.monotonic()
+
+    async def is_usable(self):
+        if self.checked_at is None or time.monotonic() - self.checked_at >= config.replica_lag_check_interval:
+            async with self.lock:
+                # Concurrent requests share one lag query
+                if self.checked_at is None or time.monotonic() - self.checked_at >= config.replica_lag_check_interval:
+                    await self.check()
+        return self.usable
+
+
+replica_monitor = ReplicaMonitor(read_engine) if read_engine is not None else None
+
+
 async def init_models():
     async with async_engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
@@ -26,19 +84,71 @@ async def get_db():
             await session.close()
 
 
+async def read_session_factory():
+    if replica_monitor is not None and await replica_monitor.is_usable():
+        return ReadSessionLocal
+    return SessionLocal
+
+
+async def get_read_db():
+    # For reads that tolerate REPLICA_MAX_LAG seconds of staleness, writes must keep using get_db
+    session_factory = await read_session_factory()
+    async with session_factory() as session:
+        try:
+            yield session
+        finally:
+            await session.close()
+
+
 async def connect_to_db():
-    retries = 5
-    while retries > 0:
+    for attempt in range(config.db_connect_retries):
         try:
-            async with async_engine.begin() as conn:
+            async with async_engine.connect():
                 print("Connected to the database!")
-                return conn
+                return
         except Exception as e:
-            print(f"Database connection failed: {e}")
-            retries -= 1
-            await asyncio.sleep(5)
+            if attempt == config.db_connect_retries - 1:
+                print(f"Database connection failed: {e}")
+                break
+            # Exponential backoff with full jitter, so workers booting together do not retry in lockstep
+            delay = random.uniform(0, min(config.db_connect_backoff_max, config.db_connect_backoff * 2**attempt))
+            print(f"Database connection failed: {e}, retrying in {delay:.2f}s")
+            await asyncio.sleep(delay)
     raise Exception("Failed to connect to the database after retries.")
 
 
+def alembic_heads():
+    # Read from the migration scripts on disk, no database access
+    from alembic.config import Config
+    from alembic.script import ScriptDirectory
+
+    alembic_config = Config(os.path.join(PROJECT_ROOT, "alembic.ini"))
+    # alembic.ini points at the scripts relative to the working directory, uvicorn may run from elsewhere
+    alembic_config.set_main_option("script_location", os.path.join(PROJECT_ROOT, "alembic"))
+    return set(ScriptDirectory.from_config(alembic_config).get_heads())
+
+
+async def fetch_schema_revisions():
+    async with async_engine.connect() as conn:
+        result = await conn.execute(text("SELECT version_num FROM alembic_version"))
+        return {row[0] for row in result}
+
+
+async def verify_schema():
+    # One query against alembic_version instead of reflecting every table like create_all does
+    expected, result = await asyncio.gather(asyncio.to_thread(alembic_heads), fetch_schema_revisions())
+    if result != expected:
+        raise Exception(f"Database schema is at {', '.join(sorted(result)) or 'no revision'}, expected {', '.join(sorted(expected))}. Run `alembic upgrade head`.")
+
+
+async def warm_pool(connections: int, engine=async_engine):
+    # Hold the connections at the same time so the pool really opens that many
+    async def checkout():
+        async with engine.connect() as conn:
+            await conn.execute(text("SELECT 1"))
+
+    await asyncio.gather(*(checkout() for _ in range(min(connections, engine.pool.size()))))
+
+
 if __name__ == "__main__":
     asyncio.run(connect_to_db())
@@ -0,0 +1,165 @@
+from collections import Counter
+from contextvars import ContextVar
+from datetime import datetime
+from itertools import count
+from sqlalchemy import event
+from app.config import config
+import heapq
+import re
+import time
+
+SLOWEST_QUERIES_KEPT = 20
+LOGGED_PARAMETERS_LENGTH = 500
+EXPLAINABLE_OPERATIONS = ("SELECT",)
+# Calls whose effect outlives the rolled-back transaction (session advisory locks, sequences, settings, notifications) or that
+# act on other sessions, a SELECT running one is only planned, never executed
+SIDE_EFFECT_FUNCTIONS = re.compile(
+    r"\b(pg_advisory\w*|pg_try_advisory\w*|nextval|setval|set_config|pg_notify|pg_sleep\w*|pg_terminate_backend|pg_cancel_backend|lo_\w+|dblink\w*)\s*\(",
+    re.IGNORECASE,
+)
+TABLE_READ = re.compile(r"\bFROM\b", re.IGNORECASE)
+
+# Query counts of the request being served, None outside a request or when per-request diagnostics are off
+current_request = ContextVar("current_request", default=None)
+
+# Min-heap of the slowest statements since startup, the root is the fastest one kept
+slowest_queries = []
+slowest_sequence = count()
+
+
+class RequestQueries:
+    def __init__(self, scope):
+        self.scope = scope
+        self.count = 0
+        self.seconds = 0.0
+        self.statements = Counter()
+        self.flagged = set()
+
+    @property
+    def route(self):
+        # The router stores the matched route in the scope once routing is done
+        route = self.scope.get("route")
+        return f"{self.scope['method']} {route.path if route is not None else self.scope['path']}"
+
+
+def mask_parameters(parameters):
+    # Keeps the shape and types of the bind parameters, the values can hold customer data
+    if isinstance(parameters, dict):
+        return {key: mask_parameters(value) for key, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        return type(parameters)(mask_parameters(value) for value in parameters)
+    return parameters if parameters is None else f"<{type(parameters).__name__}>"
+
+
+def format_parameters(parameters):
+    text = repr(parameters if config.slow_query_parameters else mask_parameters(parameters))
+    return text if len(text) <= LOGGED_PARAMETERS_LENGTH else text[:LOGGED_PARAMETERS_LENGTH] + "..."
+
+
+def keep_slow_query(seconds: float, statement: str, parameters, route):
+    record = {"seconds": seconds, "statement": statement, "parameters": parameters, "route": route, "executed_at": datetime.now()}
+    entry = (seconds, next(slowest_sequence), record)
+    if len(slowest_queries) < SLOWEST_QUERIES_KEPT:
+        heapq.heappush(slowest_queries, entry)
+    elif seconds > slowest_queries[0][0]:
+        heapq.heapreplace(slowest_queries, entry)
+
+
+# region ENGINE EVENTS
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("diagnostics_started", []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    seconds = time.perf_counter() - conn.info["diagnostics_started"].pop()
+    request = current_request.get()
+    # Plans run by slow_query_report are diagnostics of their own, not application queries
+    explaining = statement.lstrip().upper().startswith("EXPLAIN")
+
+    if request is not None:
+        request.count += 1
+        request.seconds += seconds
+        # executemany already batches its rows, only repeated single statements point at a loop
+        if not executemany and not explaining:
+            request.statements[statement] += 1
+            repeats = request.statements[statement]
+            if repeats >= config.n_plus_one_threshold and statement not in request.flagged:
+                request.flagged.add(statement)
+                print(f"[n+1] {request.route} ran the same statement {repeats} times: {' '.join(statement.split())}")
+
+    if seconds * 1000 >= config.slow_query_threshold_ms and not explaining:
+        route = request.route if request is not None else None
+        keep_slow_query(seconds, statement, parameters, route)
+        print(f"[slow query] {seconds * 1000:.1f}ms route={route} {' '.join(statement.split())} parameters={format_parameters(parameters)}")
+
+
+def handle_error(exception_context):
+    started = exception_context.connection.info.get("diagnostics_started") if exception_context.connection is not None else None
+    if started:
+        started.pop()
+
+
+def instrument_queries(engine):
+    sync_engine = engine.sync_engine
+    if event.contains(sync_engine, "before_cursor_execute", before_cursor_execute):
+        return
+    event.listen(sync_engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(sync_engine, "after_cursor_execute", after_cursor_execute)
+    event.listen(sync_engine, "handle_error", handle_error)
+
+
+# endregion
+
+
+# region SLOW QUERIES
+async def explain(engine, statement: str, parameters):
+    # EXPLAIN ANALYZE runs the statement, so only table reads are executed and the transaction is rolled back
+    analyze = TABLE_READ.search(statement) and not SIDE_EFFECT_FUNCTIONS.search(statement)
+    async with engine.connect() as conn:
+        try:
+            result = await conn.exec_driver_sql(f"{'EXPLAIN (ANALYZE, BUFFERS)' if analyze else 'EXPLAIN'} {statement}", parameters)
+            return "\n".join(row[0] for row in result)
+        finally:
+            await conn.rollback()
+
+
+async def slow_query_report(engine, with_explain: bool = False):
+    queries = []
+    for seconds, _, record in sorted(slowest_queries, reverse=True):
+        query = dict(record, parameters=format_parameters(record["parameters"]), plan=None)
+        if with_explain and record["statement"].lstrip().upper().startswith(EXPLAINABLE_OPERATIONS):
+            try:
+                query["plan"] = await explain(engine, record["statement"], record["parameters"])
+            except Exception as e:
+                query["plan"] = f"EXPLAIN failed: {e}"
+        queries.append(query)
+    return {"threshold_ms": config.slow_query_threshold_ms, "queries": queries}
+
+
+# endregion
+
+
+class QueryDiagnosticsMiddleware:
+    # Counts the statements of each request, logs the total and flags repeated statements
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request = RequestQueries(scope)
+        token = current_request.set(request)
+
+        async def send_with_query_count(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = [*message.get("headers", []), (b"x-query-count", str(request.count).encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_query_count)
+        finally:
+            current_request.reset(token)
+            if request.count:
+                print(f"[queries] {request.route} {request.count} statements {request.seconds * 1000:.1f}ms")
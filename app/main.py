@@ -2,15 +2,54 @@ from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from contextlib import asynccontextmanager
 from app.routes import router
-from app.db import init_models, connect_to_db
+from app.db import async_engine, read_engine, replica_monitor, init_models, connect_to_db, verify_schema, warm_pool
+from app.diagnostics import QueryDiagnosticsMiddleware, instrument_queries
+from app.metrics import MetricsMiddleware, instrument_engine, mark_worker_dead, metrics_endpoint
+from app.scheduler import segmentation_scheduler
+from app.config import config
+from sqlalchemy.orm import configure_mappers
+import asyncio
+import time
+
+
+def warm_models():
+    configure_mappers()
+    if config.ml_enabled and config.online_scoring:
+        # Transactions score against these right away, load them before the first sale instead of during it
+        from app.segmentation import load_scoring_models
+
+        load_scoring_models()
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     try:
+        started = time.perf_counter()
+        if config.secret_key_generated:
+            # Per-worker keys silently break auth across workers, only development (create_all) gets away with a warning
+            if config.startup_schema != "create_all":
+                raise Exception("SECRET_KEY is not set, every worker would sign tokens with its own random key")
+            print("WARNING: SECRET_KEY is not set, this worker signs tokens with its own random key. Tokens it issues fail on every other worker and after a restart.")
         await connect_to_db()
-        await init_models()
+
+        # create_all reflects every table, production workers only compare the Alembic revision
+        schema_checks = {"create_all": init_models, "alembic": verify_schema, "skip": None}
+        if config.startup_schema not in schema_checks:
+            raise Exception(f"Unknown STARTUP_SCHEMA {config.startup_schema!r}, use one of {', '.join(schema_checks)}")
+        warmups = [warm_pool(config.db_pool_warm), asyncio.to_thread(warm_models)]
+        if schema_checks[config.startup_schema]:
+            warmups.append(schema_checks[config.startup_schema]())
+        if replica_monitor is not None:
+            # A replica that is down or behind only sends reads to the primary, it never blocks startup
+            warmups.append(replica_monitor.check())
+        await asyncio.gather(*warmups)
+        print(f"Ready in {time.perf_counter() - started:.2f}s")
+
+        if config.resegment_scheduler and config.ml_enabled:
+            segmentation_scheduler.start()
         yield
+        await segmentation_scheduler.stop()
+        mark_worker_dead()
     except Exception as e:
         print(f"Failed to initialize the application: {e}")
         raise
@@ -28,4 +67,18 @@ app.add_middleware(
 
 app.include_router(router)
 
+instrument_queries(async_engine)
+if read_engine is not None:
+    instrument_queries(read_engine)
+if config.query_diagnostics:
+    app.add_middleware(QueryDiagnosticsMiddleware)
+
+if config.metrics_enabled:
+    # Added last so it wraps CORS too and times the whole request
+    app.add_middleware(MetricsMiddleware)
+    app.add_api_route("/metrics", metrics_endpoint, include_in_schema=False)
+    instrument_engine(async_engine)
+    if read_engine is not None:
+        instrument_engine(read_engine, "replica")
+
 # ? Run with: `uvicorn app.main:app --reload`
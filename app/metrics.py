@@ -0,0 +1,160 @@
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+from sqlalchemy import event
+from starlette.requests import Request
+from starlette.responses import Response
+import asyncio
+import os
+import time
+
+# With several uvicorn workers, PROMETHEUS_MULTIPROC_DIR makes every worker write its samples there and a scrape of any
+# worker aggregates all of them. prometheus_client reads it at import, so it has to be in the environment, not in .env.
+MULTIPROCESS_DIRECTORY = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+
+# Request latency spans cache hits (~1ms) to un-cached segmentation fits (minutes)
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+QUERY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SEGMENTATION_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+
+SQL_OPERATIONS = {"SELECT", "INSERT", "UPDATE", "DELETE", "WITH", "COPY", "BEGIN", "COMMIT", "ROLLBACK"}
+
+http_requests_total = Counter("http_requests_total", "HTTP requests by route template and status", ["method", "route", "status"])
+http_request_duration_seconds = Histogram(
+    "http_request_duration_seconds", "HTTP request latency by route template", ["method", "route"], buckets=REQUEST_BUCKETS
+)
+http_requests_in_flight = Gauge("http_requests_in_flight", "HTTP requests being served", multiprocess_mode="livesum")
+
+db_queries_total = Counter("db_queries_total", "SQL statements executed, by leading keyword", ["operation"])
+db_query_errors_total = Counter("db_query_errors_total", "SQL statements that raised, by leading keyword", ["operation"])
+db_query_duration_seconds = Histogram("db_query_duration_seconds", "SQL statement execution time", ["operation"], buckets=QUERY_BUCKETS)
+
+segmentation_stage_duration_seconds = Histogram(
+    "segmentation_stage_duration_seconds", "Segmentation pipeline stage duration", ["stage", "algorithm"], buckets=SEGMENTATION_BUCKETS
+)
+segmentation_job_duration_seconds = Histogram(
+    "segmentation_job_duration_seconds", "Scheduled re-segmentation run duration", ["outcome"], buckets=SEGMENTATION_BUCKETS
+)
+
+
+def observe_stage(stage: str, seconds: float, algorithm: str = None):
+    segmentation_stage_duration_seconds.labels(stage=stage, algorithm=algorithm or "").observe(seconds)
+
+
+# region DATABASE
+def sql_operation(statement: str):
+    keyword = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else ""
+    return keyword if keyword in SQL_OPERATIONS else "OTHER"
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info["query_started"].pop()
+    operation = sql_operation(statement)
+    db_queries_total.labels(operation=operation).inc()
+    db_query_duration_seconds.labels(operation=operation).observe(time.perf_counter() - started)
+
+
+def handle_error(exception_context):
+    # after_cursor_execute does not run for a failed statement, drop its start time here
+    started = exception_context.connection.info.get("query_started") if exception_context.connection is not None else None
+    if started:
+        started.pop()
+        db_query_errors_total.labels(operation=sql_operation(exception_context.statement or "")).inc()
+
+
+# Set per worker when the pool changes, summed over the live workers in multiprocess mode. checkin and close fire before the
+# pool updates its counters, so the gauges are read once the current step is done.
+POOL_GAUGES = (
+    (Gauge("db_pool_size", "Connections the pools keep open", ["engine"], multiprocess_mode="livesum"), "size"),
+    (Gauge("db_pool_checked_out", "Connections in use", ["engine"], multiprocess_mode="livesum"), "checkedout"),
+    (Gauge("db_pool_checked_in", "Idle connections in the pools", ["engine"], multiprocess_mode="livesum"), "checkedin"),
+    (
+        Gauge("db_pool_overflow", "Connections opened beyond the pool size, negative while a pool is not full", ["engine"], multiprocess_mode="livesum"),
+        "overflow",
+    ),
+)
+POOL_EVENTS = ("connect", "checkout", "checkin", "close", "close_detached", "invalidate")
+
+
+def refresh_pool_gauges(name: str, pool):
+    for gauge, reader in POOL_GAUGES:
+        gauge.labels(engine=name).set(getattr(pool, reader)())
+
+
+def watch_pool(engine, name: str):
+    pool = engine.sync_engine.pool
+
+    def pool_changed(*args):
+        try:
+            asyncio.get_running_loop().call_soon(refresh_pool_gauges, name, pool)
+        except RuntimeError:
+            # Outside the event loop (connection garbage-collected in another thread), the next event corrects it
+            refresh_pool_gauges(name, pool)
+
+    for identifier in POOL_EVENTS:
+        event.listen(engine.sync_engine, identifier, pool_changed)
+    refresh_pool_gauges(name, pool)
+
+
+def instrument_engine(engine, name: str = "primary"):
+    sync_engine = engine.sync_engine
+    if event.contains(sync_engine, "before_cursor_execute", before_cursor_execute):
+        return
+    event.listen(sync_engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(sync_engine, "after_cursor_execute", after_cursor_execute)
+    event.listen(sync_engine, "handle_error", handle_error)
+    watch_pool(engine, name)
+
+
+# endregion
+
+
+# region HTTP
+class MetricsMiddleware:
+    # Plain ASGI so streaming responses are timed to their last chunk
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        http_requests_in_flight.inc()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            http_requests_in_flight.dec()
+            # The router stores the matched route in the scope, its template keeps the label count bounded
+            route = scope.get("route")
+            route_label = route.path if route is not None else "unmatched"
+            http_request_duration_seconds.labels(method=scope["method"], route=route_label).observe(time.perf_counter() - started)
+            http_requests_total.labels(method=scope["method"], route=route_label, status=str(status)).inc()
+
+
+async def metrics_endpoint(request: Request):
+    if MULTIPROCESS_DIRECTORY:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+def mark_worker_dead():
+    # Drops this worker's live gauges (in-flight requests, pools) from the aggregate when it exits
+    if MULTIPROCESS_DIRECTORY:
+        multiprocess.mark_process_dead(os.getpid())
+
+
+# endregion
@@ -1,9 +1,8 @@
 from datetime import datetime
-from sqlalchemy import Column, String, Integer, ForeignKey, Enum, Date, DateTime, Numeric, Boolean
+from sqlalchemy import Column, String, Integer, ForeignKey, Enum, Date, DateTime, Numeric, Boolean, Index, LargeBinary, DDL, event, text
 from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
-from app.utils import generate_membership_id
 import enum, uuid
 
 Base = declarative_base()
@@ -80,7 +79,8 @@ class Customer(Base):
 
 class Membership(Base):
     __tablename__ = "memberships"
-    id = Column(String(9), primary_key=True, default=generate_membership_id)
+    # Allocated by next_membership_id(), see MEMBERSHIP_ID_DDL
+    id = Column(String(9), primary_key=True, server_default=text("next_membership_id()"))
     customer_id = Column(UUID(as_uuid=True), ForeignKey("customers.id"), nullable=False)
     start_period = Column(Date, nullable=False)
     end_period = Column(Date, nullable=False)
@@ -89,6 +89,40 @@ class Membership(Base):
     created_at = Column(DateTime, default=datetime.now, nullable=False)
     updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now, nullable=False)
 
+    # Keyset pagination order for the listing endpoints
+    __table_args__ = (Index("ix_memberships_created_at_id", "created_at", "id"),)
+
+
+# Membership IDs are GSR- followed by a sequence value in fixed-width base36, so they never collide and sort in insert order.
+# Five characters cover 36^5 memberships, IDs left over from the old random generator are skipped.
+MEMBERSHIP_ID_DDL = [
+    "CREATE SEQUENCE IF NOT EXISTS membership_id_seq MINVALUE 0 MAXVALUE 60466175 START 0 NO CYCLE",
+    """
+    CREATE OR REPLACE FUNCTION next_membership_id() RETURNS varchar(9) AS $$
+    DECLARE
+        alphabet CONSTANT text := '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ';
+        n bigint;
+        suffix text;
+    BEGIN
+        LOOP
+            n := nextval('membership_id_seq');
+            suffix := '';
+            FOR i IN 1..5 LOOP
+                suffix := substr(alphabet, CAST(mod(n, 36) AS int) + 1, 1) || suffix;
+                n := n / 36;
+            END LOOP;
+            EXIT WHEN NOT EXISTS (SELECT 1 FROM memberships WHERE id = 'GSR-' || suffix);
+        END LOOP;
+        RETURN 'GSR-' || suffix;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+]
+
+# create_all needs the function before the table whose default calls it
+for statement in MEMBERSHIP_ID_DDL:
+    event.listen(Membership.__table__, "before_create", DDL(statement))
+
 
 Customer.memberships = relationship("Membership", back_populates="customer")
 
@@ -101,6 +135,9 @@ class ProductCategory(Base):
     created_at = Column(DateTime, default=datetime.now, nullable=False)
     updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now, nullable=False)
 
+    # Keyset pagination order for the listing endpoints
+    __table_args__ = (Index("ix_product_categories_created_at_id", "created_at", "id"),)
+
 
 class Product(Base):
     __tablename__ = "products"
@@ -115,6 +152,9 @@ class Product(Base):
     created_at = Column(DateTime, default=datetime.now, nullable=False)
     updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now, nullable=False)
 
+    # Keyset pagination order for the listing endpoints
+    __table_args__ = (Index("ix_products_created_at_id", "created_at", "id"),)
+
 
 ProductCategory.products = relationship("Product", back_populates="category")
 
@@ -131,6 +171,9 @@ class Transaction(Base):
     created_at = Column(DateTime, default=datetime.now, nullable=False)
     updated_at = Column(DateTime, default=datetime.now, onupdate=datetime.now, nullable=False)
 
+    # Keyset pagination order for the listing endpoints
+    __table_args__ = (Index("ix_transactions_created_at_id", "created_at", "id"),)
+
 
 Customer.transactions = relationship("Transaction", back_populates="customer")
 Membership.transactions = relationship("Transaction", back_populates="membership")
@@ -169,5 +212,17 @@ class SegmentationResult(Base):
 
     customer = relationship("Customer", back_populates="segmentation_results")
 
+    # One row per customer and algorithm, backs the per-customer segment lookups
+    __table_args__ = (Index("ix_segmentation_results_algorithm_customer_id", "algorithm", "customer_id", unique=True),)
+
 
 Customer.segmentation_results = relationship("SegmentationResult", back_populates="customer")
+
+
+class SharedCacheEntry(Base):
+    # Backs SHARED_CACHE_BACKEND=postgres, values are pickled
+    __tablename__ = "shared_cache"
+    key = Column(String, primary_key=True)
+    value = Column(LargeBinary, nullable=False)
+    stored_at = Column(DateTime, nullable=False)
+    expires_at = Column(DateTime, nullable=False, index=True)
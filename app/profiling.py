@@ -0,0 +1,104 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from app.metrics import observe_stage
+import cProfile
+import io
+import pstats
+import psutil
+import threading
+import time
+
+PROFILE_TOP_FUNCTIONS = 30
+
+process = psutil.Process()
+
+# Spans of the request being traced, None outside a trace
+current_spans = ContextVar("current_spans", default=None)
+
+# Running totals per stage since startup
+stage_stats = {}
+stage_stats_lock = threading.Lock()
+
+# Only one cProfile can hook the event loop thread at a time, concurrent profile requests get spans only
+profiler_lock = threading.Lock()
+
+
+class Span:
+    def __init__(self, stage: str, attributes: dict):
+        self.stage = stage
+        self.attributes = attributes
+        self.rows = None
+
+    def set_rows(self, rows: int):
+        self.rows = int(rows)
+
+
+def record_stage(stage: str, seconds: float, rows):
+    with stage_stats_lock:
+        stats = stage_stats.setdefault(stage, {"count": 0, "total_seconds": 0.0, "max_seconds": 0.0, "last_seconds": 0.0, "last_rows": None})
+        stats["count"] += 1
+        stats["total_seconds"] += seconds
+        stats["max_seconds"] = max(stats["max_seconds"], seconds)
+        stats["last_seconds"] = seconds
+        stats["last_rows"] = rows
+
+
+def stage_summary():
+    with stage_stats_lock:
+        return {stage: dict(stats, avg_seconds=stats["total_seconds"] / stats["count"]) for stage, stats in sorted(stage_stats.items())}
+
+
+@contextmanager
+def span(stage: str, rows: int = None, **attributes):
+    # Times a pipeline stage, logs it, adds it to the stage totals and to the current trace if there is one
+    current = Span(stage, attributes)
+    if rows is not None:
+        current.set_rows(rows)
+    rss_before = process.memory_info().rss
+    started = time.perf_counter()
+    try:
+        yield current
+    finally:
+        seconds = time.perf_counter() - started
+        rss_delta_mb = (process.memory_info().rss - rss_before) / 2**20
+        record_stage(stage, seconds, current.rows)
+        observe_stage(stage, seconds, attributes.get("algorithm"))
+
+        details = " ".join(f"{key}={value}" for key, value in attributes.items())
+        rows_text = f" rows={current.rows}" if current.rows is not None else ""
+        print(f"[segmentation] {stage} {seconds:.3f}s{rows_text} rss={rss_delta_mb:+.1f}MB {details}".rstrip())
+
+        spans = current_spans.get()
+        if spans is not None:
+            spans.append({"stage": stage, "seconds": seconds, "rows": current.rows, "rss_delta_mb": rss_delta_mb, **attributes})
+
+
+class Trace:
+    def __init__(self, profile: bool):
+        self.spans = []
+        self.profiler = cProfile.Profile() if profile and profiler_lock.acquire(blocking=False) else None
+
+    def report(self):
+        report = {"spans": self.spans, "cprofile": None}
+        if self.profiler:
+            output = io.StringIO()
+            pstats.Stats(self.profiler, stream=output).sort_stats("cumulative").print_stats(PROFILE_TOP_FUNCTIONS)
+            report["cprofile"] = output.getvalue()
+        return report
+
+
+@contextmanager
+def trace(profile: bool = False):
+    # Collects the spans of one request, plus a cProfile of the request's thread when profile is set.
+    # Work handed to executor threads only appears through its spans.
+    request_trace = Trace(profile)
+    token = current_spans.set(request_trace.spans)
+    if request_trace.profiler:
+        request_trace.profiler.enable()
+    try:
+        yield request_trace
+    finally:
+        if request_trace.profiler:
+            request_trace.profiler.disable()
+            profiler_lock.release()
+        current_spans.reset(token)
@@ -1,17 +1,20 @@
-import random
-from typing import List
+from typing import Dict, List, Union
 from sqlalchemy.ext.asyncio import AsyncSession
 from pydantic import UUID4
-from fastapi import APIRouter, Depends, Query
-from faker import Faker
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.responses import StreamingResponse
+from fastapi.security import HTTPAuthorizationCredentials
 from datetime import datetime
-from app.utils import error_response, success_response
+from app.utils import error_response, success_response, etag_matches, not_modified_response
 from app.services import *
 from app.schemas import *
 from app.models import *
-from app.db import get_db
-
-fake = Faker()
+from app.config import config
+from app.db import async_engine, get_db, get_read_db
+from app.diagnostics import slow_query_report
+from app.security import bearer_scheme, get_admin_user, get_current_user, revoke_access_token
+from app.scheduler import segmentation_scheduler
+from app.profiling import stage_summary, trace
 
 router = APIRouter()
 
@@ -29,7 +32,7 @@ async def register_user(user: UserCreate, db: AsyncSession = Depends(get_db)):
         return error_response(500, f"An error occurred while registering user: {str(e)}")
 
 
-@router.post("/login", response_model=UserSchema)
+@router.post("/login", response_model=LoginSchema)
 async def login_user(user: UserLogin, db: AsyncSession = Depends(get_db)):
     try:
         service = AuthService(db)
@@ -41,6 +44,17 @@ async def login_user(user: UserLogin, db: AsyncSession = Depends(get_db)):
         return error_response(500, f"An error occurred while logging in user: {str(e)}")
 
 
+@router.get("/me", response_model=CurrentUserSchema)
+async def get_me(claims: dict = Depends(get_current_user)):
+    current_user = {"id": claims["sub"], "username": claims["username"], "role": claims["role"], "expires_at": datetime.fromtimestamp(claims["exp"])}
+    return success_response(200, "Current user retrieved successfully", current_user)
+
+
+@router.post("/logout", response_model=bool)
+async def logout_user(claims: dict = Depends(get_current_user), credentials: HTTPAuthorizationCredentials = Depends(bearer_scheme)):
+    return success_response(200, "User logged out successfully", revoke_access_token(credentials.credentials))
+
+
 # endregion
 
 
@@ -49,7 +63,7 @@ async def login_user(user: UserLogin, db: AsyncSession = Depends(get_db)):
 async def get_dashboard_metrics(
     start_date: str = Query(None, description="Start date in YYYY-MM-DD format"),
     end_date: str = Query(None, description="End date in YYYY-MM-DD format"),
-    db: AsyncSession = Depends(get_db),
+    db: AsyncSession = Depends(get_read_db),
 ):
     try:
         start_date_dt = datetime.strptime(start_date, "%Y-%m-%d") if start_date else None
@@ -64,28 +78,48 @@ async def get_dashboard_metrics(
         return error_response(500, f"An error occurred while retrieving dashboard metrics: {str(e)}")
 
 
-@router.get("/dashboard/segmentation", response_model=CustomerSegmentsSchema)
+@router.get("/dashboard/segmentation", response_model=Union[CustomerSegmentsSchema, MultiCustomerSegmentsSchema])
 async def get_dashboard_segmentation(
     start_date: str = Query(None, description="Start date in YYYY-MM-DD format"),
     end_date: str = Query(None, description="End date in YYYY-MM-DD format"),
-    model: str = Query("kmeans", regex="^(kmeans|dbscan)$"),
+    model: str = Query("kmeans", regex="^(all|(kmeans|dbscan)(,(kmeans|dbscan))*)$", description="kmeans, dbscan, a comma-separated list or all"),
+    profile: bool = Query(False, description="Add per-stage timings and a cProfile summary of this request to the response"),
     db: AsyncSession = Depends(get_db),
+    read_db: AsyncSession = Depends(get_read_db),
 ):
+    if not config.ml_enabled:
+        return error_response(503, "Segmentation is disabled on this worker")
     try:
         start_date_dt = datetime.strptime(start_date, "%Y-%m-%d") if start_date else None
         end_date_dt = datetime.strptime(end_date, "%Y-%m-%d") if end_date else None
 
-        segmentation_service = SegmentationService(db)
-        await segmentation_service.preprocess(start_date=start_date_dt, end_date=end_date_dt, algorithm=model)
-
-        if model == "kmeans":
-            await segmentation_service.with_kmeans()
-        elif model == "dbscan":
-            await segmentation_service.with_dbscan()
-        else:
-            return error_response(400, "Invalid model specified. Choose either 'kmeans' or 'dbscan'.")
-
-        segmentation_result = await segmentation_service.result()
+        # pandas and scikit-learn load with the first segmentation request, not at startup
+        from app.segmentation import SegmentationService
+
+        segmentation_service = SegmentationService(db, read_db)
+
+        with trace(profile) as request_trace:
+            # Several algorithms share one RFM computation and are fitted concurrently
+            algorithms = SEGMENTATION_ALGORITHMS if model == "all" else list(dict.fromkeys(model.split(",")))
+            if len(algorithms) > 1:
+                segmentation_result = await segmentation_service.with_algorithms(algorithms, start_date=start_date_dt, end_date=end_date_dt)
+            else:
+                model = algorithms[0]
+                await segmentation_service.preprocess(start_date=start_date_dt, end_date=end_date_dt, algorithm=model)
+
+                # preprocess serves stored results when there are any, only fresh RFM features need fitting
+                if segmentation_service.df_rfm is not None:
+                    if model == "kmeans":
+                        await segmentation_service.with_kmeans()
+                    elif model == "dbscan":
+                        await segmentation_service.with_dbscan()
+                    else:
+                        return error_response(400, "Invalid model specified. Choose either 'kmeans' or 'dbscan'.")
+
+                segmentation_result = await segmentation_service.result()
+
+        if profile:
+            segmentation_result["profile"] = request_trace.report()
         return success_response(200, "Dashboard segmentation retrieved successfully", segmentation_result)
     except ValueError as e:
         return error_response(400, f"Invalid date format: {str(e)}")
@@ -93,46 +127,106 @@ async def get_dashboard_segmentation(
         return error_response(500, f"An error occurred while retrieving dashboard segmentation: {str(e)}")
 
 
+@router.get("/segmentation/scheduler", response_model=SchedulerStatusSchema)
+async def get_segmentation_scheduler():
+    try:
+        return success_response(200, "Segmentation scheduler status retrieved successfully", segmentation_scheduler.status())
+    except Exception as e:
+        return error_response(500, f"An error occurred while retrieving segmentation scheduler status: {str(e)}")
+
+
+@router.get("/segmentation/stages", response_model=Dict[str, StageStatsSchema])
+async def get_segmentation_stages():
+    try:
+        return success_response(200, "Segmentation stage timings retrieved successfully", stage_summary())
+    except Exception as e:
+        return error_response(500, f"An error occurred while retrieving segmentation stage timings: {str(e)}")
+
+
+@router.get("/diagnostics/slow-queries")
+async def get_slow_queries(
+    explain: bool = Query(False, description="Run EXPLAIN ANALYZE on the slowest reads, needs SLOW_QUERY_EXPLAIN"), claims: dict = Depends(get_admin_user)
+):
+    if explain and not config.slow_query_explain:
+        return error_response(400, "EXPLAIN ANALYZE is disabled, set SLOW_QUERY_EXPLAIN=true to enable it")
+    try:
+        return success_response(200, "Slow queries retrieved successfully", await slow_query_report(async_engine, explain))
+    except Exception as e:
+        return error_response(500, f"An error occurred while retrieving slow queries: {str(e)}")
+
+
+@router.get("/segmentation/export")
+async def export_segmentation(
+    algorithm: str = Query("kmeans", regex="^(kmeans|dbscan)$"),
+    format: str = Query("ndjson", regex="^(ndjson|csv|parquet)$"),
+    gzip: bool = Query(False, description="Compress the export with gzip"),
+):
+    try:
+        service = SegmentationExportService(algorithm, format, gzip)
+        headers = {"Content-Disposition": f'attachment; filename="{service.filename}"'}
+        return StreamingResponse(service.stream(), media_type=service.media_type, headers=headers)
+    except Exception as e:
+        return error_response(500, f"An error occurred while exporting segmentation results: {str(e)}")
+
+
 # endregion
 
 
 # region PRODUCTS
 @router.get("/product-categories/", response_model=List[ProductCategorySchema])
 async def get_product_categories(
+    request: Request,
     limit: int = Query(10, description="Number of records to fetch"),
-    offset: int = Query(0, description="Number of records to skip"),
+    offset: int = Query(0, description="Number of records to skip, ignored when a cursor is given"),
+    cursor: str = Query(None, description="Cursor from pagination.next_cursor of the previous page"),
+    with_total: bool = Query(False, description="Include a planner-estimated total count"),
+    # The catalog cache is filled from the primary, a lagging replica would cache pre-write rows for CATALOG_CACHE_TTL
     db: AsyncSession = Depends(get_db),
 ):
     try:
         service = ProductService(db)
-        categories = await service.get_product_categories(limit, offset)
-        return success_response(200, "Product categories retrieved successfully", categories)
+        categories, pagination, etag = await service.get_product_categories(limit, offset, cursor, with_total)
+        if etag_matches(request, etag):
+            return not_modified_response(etag)
+        return success_response(200, "Product categories retrieved successfully", categories, pagination, headers={"ETag": etag})
+    except ValueError as e:
+        return error_response(400, str(e))
     except Exception as e:
         return error_response(500, f"An error occurred while retrieving product categories: {str(e)}")
 
 
 @router.get("/products/", response_model=List[ProductSchema])
 async def get_products(
+    request: Request,
     limit: int = Query(10, description="Number of records to fetch"),
-    offset: int = Query(0, description="Number of records to skip"),
+    offset: int = Query(0, description="Number of records to skip, ignored when a cursor is given"),
+    cursor: str = Query(None, description="Cursor from pagination.next_cursor of the previous page"),
+    with_total: bool = Query(False, description="Include a planner-estimated total count"),
+    # The catalog cache is filled from the primary, a lagging replica would cache pre-write rows for CATALOG_CACHE_TTL
     db: AsyncSession = Depends(get_db),
 ):
     try:
         service = ProductService(db)
-        products = await service.get_products(limit, offset)
-        return success_response(200, "Products retrieved successfully", products)
+        products, pagination, etag = await service.get_products(limit, offset, cursor, with_total)
+        if etag_matches(request, etag):
+            return not_modified_response(etag)
+        return success_response(200, "Products retrieved successfully", products, pagination, headers={"ETag": etag})
+    except ValueError as e:
+        return error_response(400, str(e))
     except Exception as e:
         return error_response(500, f"An error occurred while retrieving products: {str(e)}")
 
 
 @router.get("/products/{product_id}", response_model=ProductSchema)
-async def get_product(product_id: UUID4, db: AsyncSession = Depends(get_db)):
+async def get_product(product_id: UUID4, request: Request, db: AsyncSession = Depends(get_db)):
     try:
         service = ProductService(db)
-        product = await service.get_product(product_id)
+        product, etag = await service.get_product(product_id)
         if not product:
             return error_response(404, "Product not found")
-        return success_response(200, "Product found", product)
+        if etag_matches(request, etag):
+            return not_modified_response(etag)
+        return success_response(200, "Product found", product, headers={"ETag": etag})
     except Exception as e:
         return error_response(500, f"An error occurred while retrieving product: {str(e)}")
 
@@ -175,16 +269,21 @@ async def delete_product(product_id: UUID4, db: AsyncSession = Depends(get_db)):
 
 
 # region TRANSACTIONS
-@router.get("/transactions/", response_model=List[TransactionSchema])
+@router.get("/transactions/", response_model=Union[List[TransactionSchema], List[TransactionWithDetailsSchema]])
 async def get_all_transactions(
     limit: int = Query(10, description="Number of records to fetch"),
-    offset: int = Query(0, description="Number of records to skip"),
-    db: AsyncSession = Depends(get_db),
+    offset: int = Query(0, description="Number of records to skip, ignored when a cursor is given"),
+    cursor: str = Query(None, description="Cursor from pagination.next_cursor of the previous page"),
+    with_total: bool = Query(False, description="Include a planner-estimated total count"),
+    expand: str = Query(None, regex="^details$", description="Use `details` to include the transaction details"),
+    db: AsyncSession = Depends(get_read_db),
 ):
     try:
         service = TransactionService(db)
-        transactions = await service.get_all_transactions(limit, offset)
-        return success_response(200, "Transactions retrieved successfully", transactions)
+        transactions, pagination = await service.get_all_transactions(limit, offset, cursor, with_total, expand_details=expand == "details")
+        return success_response(200, "Transactions retrieved successfully", transactions, pagination)
+    except ValueError as e:
+        return error_response(400, str(e))
     except Exception as e:
         return error_response(500, f"An error occurred while retrieving transactions: {str(e)}")
 
@@ -205,6 +304,9 @@ async def create_transaction(transaction_data: TransactionCreate, db: AsyncSessi
         service = TransactionService(db)
         new_transaction = await service.create_transaction(transaction_data)
         return success_response(201, "Transaction created successfully", new_transaction)
+    except HTTPException:
+        # Unknown products (404) and insufficient stock (409) keep their status
+        raise
     except Exception as e:
         return error_response(500, f"An error occurred while creating the transaction: {str(e)}")
 
@@ -216,13 +318,17 @@ async def create_transaction(transaction_data: TransactionCreate, db: AsyncSessi
 @router.get("/memberships/", response_model=List[MembershipSchema])
 async def get_all_memberships(
     limit: int = Query(10, description="Number of records to fetch"),
-    offset: int = Query(0, description="Number of records to skip"),
-    db: AsyncSession = Depends(get_db),
+    offset: int = Query(0, description="Number of records to skip, ignored when a cursor is given"),
+    cursor: str = Query(None, description="Cursor from pagination.next_cursor of the previous page"),
+    with_total: bool = Query(False, description="Include a planner-estimated total count"),
+    db: AsyncSession = Depends(get_read_db),
 ):
     try:
         service = MembershipService(db)
-        memberships = await service.get_all_memberships(limit, offset)
-        return success_response(200, "Memberships retrieved successfully", memberships)
+        memberships, pagination = await service.get_all_memberships(limit, offset, cursor, with_total)
+        return success_response(200, "Memberships retrieved successfully", memberships, pagination)
+    except ValueError as e:
+        return error_response(400, str(e))
     except Exception as e:
         return error_response(500, f"An error occurred while retrieving memberships: {str(e)}")
 
@@ -274,3 +380,33 @@ async def delete_membership(membership_id: UUID4, db: AsyncSession = Depends(get
 
 
 # endregion
+
+
+# region CUSTOMERS
+@router.get("/customers/{customer_id}/segment", response_model=CustomerSegmentSchema)
+async def get_customer_segment(
+    customer_id: UUID4,
+    algorithm: str = Query("kmeans", regex="^(kmeans|dbscan)$"),
+    db: AsyncSession = Depends(get_db),
+):
+    try:
+        service = CustomerService(db)
+        segment = await service.get_customer_segment(customer_id, algorithm)
+        if not segment:
+            return error_response(404, "Customer segment not found")
+        return success_response(200, "Customer segment found", segment)
+    except Exception as e:
+        return error_response(500, f"An error occurred while retrieving customer segment: {str(e)}")
+
+
+@router.post("/customers/segments", response_model=List[CustomerSegmentSchema])
+async def get_customer_segments(request: CustomerSegmentsRequest, db: AsyncSession = Depends(get_db)):
+    try:
+        service = CustomerService(db)
+        segments = await service.get_customer_segments(request.customer_ids, request.algorithm)
+        return success_response(200, "Customer segments retrieved successfully", segments)
+    except Exception as e:
+        return error_response(500, f"An error occurred while retrieving customer segments: {str(e)}")
+
+
+# endregion
@@ -0,0 +1,186 @@
+from collections import deque
+from datetime import datetime, timezone
+from sqlalchemy.sql import func
+from sqlalchemy.future import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.config import config
+from app.db import SessionLocal
+from app.metrics import segmentation_job_duration_seconds
+from app.models import AlgorithmEnum, SegmentationResult, Transaction, TransactionDetail
+from app.services import SEGMENTATION_ALGORITHMS, RFM_FEATURES, MEMBER_TRANSACTION
+import asyncio
+
+SECONDS_PER_DAY = 86400
+
+
+async def current_rfm_stats(db: AsyncSession, now: datetime):
+    # Per-customer RFM aggregated in SQL, far cheaper than the full pandas pipeline
+    per_customer = (
+        select(
+            Transaction.customer_id,
+            func.max(func.extract("epoch", Transaction.date)).label("last_date"),
+            func.count(TransactionDetail.id).label("frequency"),
+            func.sum(TransactionDetail.quantity * TransactionDetail.price_per_unit).label("monetary"),
+        )
+        .join(TransactionDetail, TransactionDetail.transaction_id == Transaction.id)
+        .where(MEMBER_TRANSACTION, TransactionDetail.quantity > 0, TransactionDetail.price_per_unit > 0)
+        .group_by(Transaction.customer_id)
+        .subquery()
+    )
+    result = await db.execute(
+        select(func.avg(per_customer.c.last_date), func.avg(per_customer.c.frequency), func.avg(per_customer.c.monetary), func.count())
+    )
+    last_date, frequency, monetary, customers = result.one()
+    if not customers:
+        return None
+
+    # Naive timestamps are stored, extract(epoch) reads them as UTC
+    recency = (now.replace(tzinfo=timezone.utc).timestamp() - float(last_date)) / SECONDS_PER_DAY
+    return {"Recency": recency, "Frequency": float(frequency), "Monetary": float(monetary), "customers": customers}
+
+
+async def last_run_stats(db: AsyncSession, algorithm: AlgorithmEnum):
+    # A batch run rewrites every row at once, so the oldest created_at marks when it ran
+    result = await db.execute(
+        select(
+            func.min(SegmentationResult.created_at),
+            func.count(),
+            func.avg(SegmentationResult.recency),
+            func.stddev_pop(SegmentationResult.recency),
+            func.avg(SegmentationResult.frequency),
+            func.stddev_pop(SegmentationResult.frequency),
+            func.avg(SegmentationResult.monetary),
+            func.stddev_pop(SegmentationResult.monetary),
+        ).where(SegmentationResult.algorithm == algorithm)
+    )
+    last_run_at, customers, *moments = result.one()
+    if not customers:
+        return None
+
+    means = dict(zip(RFM_FEATURES, (float(value or 0) for value in moments[0::2])))
+    stds = dict(zip(RFM_FEATURES, (float(value or 0) for value in moments[1::2])))
+    return {"last_run_at": last_run_at, "customers": customers, "means": means, "stds": stds}
+
+
+async def transaction_volume(db: AsyncSession, since: datetime):
+    result = await db.execute(select(func.count(Transaction.id), func.count(Transaction.id).filter(Transaction.created_at > since)).where(MEMBER_TRANSACTION))
+    total, new = result.one()
+    return total, new
+
+
+class SegmentationScheduler:
+    def __init__(self, algorithms=SEGMENTATION_ALGORITHMS):
+        self.algorithms = [AlgorithmEnum(algorithm) for algorithm in algorithms]
+        self.decisions = deque(maxlen=100)
+        self.last_checked_at = None
+        self.task = None
+        self.recompute_task = None
+
+    @property
+    def recomputing(self):
+        return self.recompute_task is not None and not self.recompute_task.done()
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        for task in (self.task, self.recompute_task):
+            if task and not task.done():
+                task.cancel()
+        self.task = None
+
+    async def run(self):
+        while True:
+            try:
+                await self.check()
+            except Exception as e:
+                print(f"Segmentation scheduler check failed: {e}")
+            await asyncio.sleep(config.resegment_check_interval)
+
+    async def check(self):
+        # A recompute already in flight covers whatever this check would find
+        if self.recomputing:
+            return []
+
+        now = datetime.now()
+        self.last_checked_at = now
+        async with SessionLocal() as db:
+            current = await current_rfm_stats(db, now)
+            if current is None:
+                return []
+
+            due = []
+            for algorithm in self.algorithms:
+                decision = await self.evaluate(db, algorithm, current, now)
+                self.decisions.appendleft(decision)
+                if decision["triggered"]:
+                    due.append(algorithm.value)
+
+        if due:
+            self.recompute_task = asyncio.create_task(self.recompute(due))
+        return due
+
+    async def evaluate(self, db: AsyncSession, algorithm: AlgorithmEnum, current: dict, now: datetime):
+        decision = {"checked_at": now, "algorithm": algorithm.value, "triggered": False, "reasons": []}
+        last_run = await last_run_stats(db, algorithm)
+        if last_run is None:
+            decision.update(triggered=True, reasons=["no segmentation results"])
+            return decision
+
+        age = (now - last_run["last_run_at"]).total_seconds()
+        total_transactions, new_transactions = await transaction_volume(db, last_run["last_run_at"])
+        volume_ratio = new_transactions / max(total_transactions - new_transactions, 1)
+
+        # Mean shift of each RFM feature in standard deviations of the last run, stored recency has aged since then
+        expected_means = dict(last_run["means"], Recency=last_run["means"]["Recency"] + age / SECONDS_PER_DAY)
+        drift = {
+            feature: abs(current[feature] - expected_means[feature]) / last_run["stds"][feature] if last_run["stds"][feature] else 0.0
+            for feature in RFM_FEATURES
+        }
+
+        if age >= config.resegment_max_age:
+            decision["reasons"].append("max age exceeded")
+        if volume_ratio >= config.resegment_volume_threshold:
+            decision["reasons"].append("transaction volume threshold exceeded")
+        if max(drift.values()) >= config.resegment_drift_threshold:
+            decision["reasons"].append("RFM drift threshold exceeded")
+
+        decision.update(
+            triggered=bool(decision["reasons"]),
+            last_run_at=last_run["last_run_at"],
+            age_seconds=age,
+            new_transactions=new_transactions,
+            volume_ratio=volume_ratio,
+            drift=drift,
+        )
+        return decision
+
+    async def recompute(self, algorithms):
+        started = datetime.now()
+        try:
+            from app.segmentation import SegmentationService
+
+            async with SessionLocal() as db:
+                await SegmentationService(db).with_algorithms(algorithms, force=True)
+            seconds = (datetime.now() - started).total_seconds()
+            segmentation_job_duration_seconds.labels(outcome="success").observe(seconds)
+            print(f"Re-segmentation of {', '.join(algorithms)} finished in {seconds:.1f}s")
+        except Exception as e:
+            segmentation_job_duration_seconds.labels(outcome="failure").observe((datetime.now() - started).total_seconds())
+            print(f"Re-segmentation of {', '.join(algorithms)} failed: {e}")
+
+    def status(self):
+        return {
+            "enabled": self.task is not None,
+            "recomputing": self.recomputing,
+            "last_checked_at": self.last_checked_at,
+            "check_interval": config.resegment_check_interval,
+            "max_age": config.resegment_max_age,
+            "volume_threshold": config.resegment_volume_threshold,
+            "drift_threshold": config.resegment_drift_threshold,
+            "decisions": list(self.decisions),
+        }
+
+
+segmentation_scheduler = SegmentationScheduler()
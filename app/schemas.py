@@ -1,7 +1,7 @@
-from pydantic import BaseModel, EmailStr, UUID4
+from pydantic import BaseModel, EmailStr, Field, UUID4
 from datetime import datetime, date
-from typing import List, Optional
-from app.models import GenderEnum, RoleEnum, TierEnum
+from typing import Dict, List, Optional
+from app.models import AlgorithmEnum, GenderEnum, RoleEnum, TierEnum
 
 
 # region Employee Schemas
@@ -51,6 +51,19 @@ class UserSchema(BaseModel):
         from_attributes = True
 
 
+class LoginSchema(UserSchema):
+    access_token: str
+    token_type: str = "bearer"
+    expires_at: datetime
+
+
+class CurrentUserSchema(BaseModel):
+    id: UUID4
+    username: str
+    role: RoleEnum
+    expires_at: datetime
+
+
 # endregion
 
 
@@ -190,16 +203,21 @@ class TransactionSchema(BaseModel):
         from_attributes = True
 
 
+class TransactionWithDetailsSchema(TransactionSchema):
+    transaction_details: List[TransactionDetailSchema]
+
+
 class TransactionDetailCreate(BaseModel):
     product_id: UUID4
-    quantity: int
-    price_per_unit: float
+    quantity: int = Field(..., gt=0)
+    # Ignored, the unit price is taken from the product catalog
+    price_per_unit: Optional[float] = None
 
 
 class TransactionCreate(BaseModel):
     membership_id: Optional[str]
     date: datetime
-    transaction_details: List[TransactionDetailCreate]
+    transaction_details: List[TransactionDetailCreate] = Field(..., min_length=1)
 
 
 # endregion
@@ -217,10 +235,87 @@ class EvaluationSchema(BaseModel):
     davies_bouldin_index: float
 
 
+class AnonymousSegmentSchema(BaseModel):
+    transactions: int
+    total_revenue: float
+
+
+class StageSpanSchema(BaseModel):
+    stage: str
+    seconds: float
+    rows: Optional[int]
+    rss_delta_mb: float
+    algorithm: Optional[str] = None
+    batch: Optional[str] = None
+
+
+class ProfileSchema(BaseModel):
+    spans: List[StageSpanSchema]
+    cprofile: Optional[str]
+
+
+class StageStatsSchema(BaseModel):
+    count: int
+    total_seconds: float
+    avg_seconds: float
+    max_seconds: float
+    last_seconds: float
+    last_rows: Optional[int]
+
+
 class CustomerSegmentsSchema(BaseModel):
     algorithm: str
     segmentation: List[SegmentationResultSchema]
     evaluation: EvaluationSchema
+    anonymous: AnonymousSegmentSchema
+    profile: Optional[ProfileSchema] = None
+
+
+class MultiCustomerSegmentsSchema(BaseModel):
+    results: List[CustomerSegmentsSchema]
+    profile: Optional[ProfileSchema] = None
+
+
+class CustomerSegmentSchema(BaseModel):
+    customer_id: UUID4
+    algorithm: AlgorithmEnum
+    rfm_category: str
+    cluster: int
+    recency: int
+    frequency: int
+    monetary: float
+    updated_at: datetime
+
+    class Config:
+        from_attributes = True
+
+
+class CustomerSegmentsRequest(BaseModel):
+    customer_ids: List[UUID4] = Field(..., min_length=1, max_length=1000)
+    algorithm: AlgorithmEnum = AlgorithmEnum.kmeans
+
+
+class SchedulerDecisionSchema(BaseModel):
+    checked_at: datetime
+    algorithm: str
+    triggered: bool
+    reasons: List[str]
+    last_run_at: Optional[datetime] = None
+    age_seconds: Optional[float] = None
+    new_transactions: Optional[int] = None
+    volume_ratio: Optional[float] = None
+    drift: Optional[Dict[str, float]] = None
+
+
+class SchedulerStatusSchema(BaseModel):
+    enabled: bool
+    recomputing: bool
+    last_checked_at: Optional[datetime]
+    check_interval: int
+    max_age: int
+    volume_threshold: float
+    drift_threshold: float
+    decisions: List[SchedulerDecisionSchema]
 
 
 # endregion
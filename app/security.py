@@ -0,0 +1,87 @@
+from fastapi import Depends
+from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
+from datetime import datetime
+from app.cache import TTLCache, MISSING
+from app.config import config
+from app.models import RoleEnum
+from app.utils import error_response
+import base64
+import hashlib
+import hmac
+import orjson
+import time
+import uuid
+
+bearer_scheme = HTTPBearer(auto_error=False)
+
+# Tokens that passed verification are remembered until they expire, repeat requests skip the signature check entirely
+verified_tokens = TTLCache(maxsize=config.token_cache_size, ttl=config.access_token_ttl)
+revoked_tokens = TTLCache(maxsize=config.token_cache_size, ttl=config.access_token_ttl)
+
+
+def b64encode(data: bytes):
+    return base64.urlsafe_b64encode(data).rstrip(b"=")
+
+
+def b64decode(data: bytes):
+    return base64.urlsafe_b64decode(data + b"=" * (-len(data) % 4))
+
+
+TOKEN_HEADER = b64encode(orjson.dumps({"alg": "HS256", "typ": "JWT"}))
+
+
+def sign(message: bytes):
+    return b64encode(hmac.new(config.secret_key.encode(), message, hashlib.sha256).digest())
+
+
+def create_access_token(user_id, username: str, role: str):
+    # Compact HS256 JWT, verifiable by any worker sharing SECRET_KEY
+    issued_at = int(time.time())
+    claims = {
+        "sub": str(user_id),
+        "username": username,
+        "role": role,
+        "iat": issued_at,
+        "exp": issued_at + config.access_token_ttl,
+        "jti": uuid.uuid4().hex,
+    }
+    message = TOKEN_HEADER + b"." + b64encode(orjson.dumps(claims))
+    return (message + b"." + sign(message)).decode(), datetime.fromtimestamp(claims["exp"])
+
+
+def decode_access_token(token: str):
+    claims = verified_tokens.get(token)
+    if claims is MISSING:
+        try:
+            header, payload, signature = token.encode().split(b".")
+            if header != TOKEN_HEADER or not hmac.compare_digest(signature, sign(header + b"." + payload)):
+                return None
+            claims = orjson.loads(b64decode(payload))
+        except ValueError:
+            return None
+        verified_tokens.set(token, claims)
+
+    if claims["exp"] <= time.time() or revoked_tokens.get(claims["jti"]) is not MISSING:
+        return None
+    return claims
+
+
+def revoke_access_token(token: str):
+    claims = decode_access_token(token)
+    if claims:
+        revoked_tokens.set(claims["jti"], True)
+        verified_tokens.delete(token)
+    return claims is not None
+
+
+async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(bearer_scheme)):
+    claims = decode_access_token(credentials.credentials) if credentials else None
+    if not claims:
+        return error_response(401, "Invalid or expired token")
+    return claims
+
+
+async def get_admin_user(claims: dict = Depends(get_current_user)):
+    if claims["role"] != RoleEnum.admin.value:
+        return error_response(403, "Admin role required")
+    return claims
@@ -0,0 +1,274 @@
+from datetime import datetime
+from faker import Faker
+from app.db import SessionLocal, async_engine
+from app.models import GenderEnum, TierEnum
+from app.services import TransactionService
+import argparse
+import asyncio
+import io
+import numpy as np
+import pandas as pd
+import time
+
+PRESETS = {
+    "small": {"customers": 1_000, "categories": 10, "products": 100, "line_items": 50_000},
+    "medium": {"customers": 100_000, "categories": 25, "products": 2_000, "line_items": 5_000_000},
+    "large": {"customers": 1_000_000, "categories": 50, "products": 10_000, "line_items": 50_000_000},
+}
+SEEDED_TABLES = ["segmentation_results", "transaction_details", "transactions", "memberships", "customers", "products", "product_categories"]
+
+# Faker is slow per call, so names, phones and addresses come from a pool that rows sample from
+FAKE_POOL_SIZE = 10_000
+# Line items generated, encoded and copied per round trip
+CHUNK_LINE_ITEMS = 500_000
+
+
+def random_uuids(rng: np.random.Generator, n: int):
+    # Version 4 UUIDs drawn from the seeded generator, as the 32 hex digits COPY accepts
+    raw = rng.integers(0, 256, size=(n, 16), dtype=np.uint8)
+    raw[:, 6] = raw[:, 6] & 0x0F | 0x40
+    raw[:, 8] = raw[:, 8] & 0x3F | 0x80
+    return np.frombuffer(raw.tobytes().hex().encode(), dtype="S32").astype(str)
+
+
+def random_datetimes(rng: np.random.Generator, start, end):
+    # Uniform between per-row (or scalar) start and end datetime64 bounds
+    span = (end - start).astype("timedelta64[us]").astype(np.int64)
+    return start + (rng.random(np.shape(span) or None) * span).astype("timedelta64[us]")
+
+
+def fake_pool(fake: Faker, make, n: int):
+    return np.array([make() for _ in range(min(n, FAKE_POOL_SIZE))])
+
+
+def build_categories(rng: np.random.Generator, fake: Faker, n: int, now):
+    names = [fake.unique.word().title() for _ in range(n)]
+    return pd.DataFrame(
+        {
+            "id": random_uuids(rng, n),
+            "name": names,
+            "description": [fake.sentence() for _ in range(n)],
+            "created_at": now,
+            "updated_at": now,
+        }
+    )
+
+
+def build_products(rng: np.random.Generator, fake: Faker, n: int, category_ids, now):
+    # Log-normal prices: most items are cheap, a long tail is expensive
+    prices = np.clip(np.round(rng.lognormal(np.log(20), 0.9, n), 2), 0.5, 5000)
+    return pd.DataFrame(
+        {
+            "id": random_uuids(rng, n),
+            "category_id": category_ids[rng.integers(0, len(category_ids), n)],
+            "name": [" ".join(fake.words(2)).title() for _ in range(n)],
+            "description": fake_pool(fake, fake.sentence, n)[rng.integers(0, min(n, FAKE_POOL_SIZE), n)],
+            "stock": rng.integers(0, 1000, n),
+            "price": prices,
+            "deleted": False,
+            "created_at": now,
+            "updated_at": now,
+        }
+    )
+
+
+def product_popularity(rng: np.random.Generator, n: int, exponent: float):
+    # Zipf: the product at popularity rank r sells in proportion to 1 / r^exponent, ranks shuffled across the catalog
+    weights = 1 / np.arange(1, n + 1) ** exponent
+    rng.shuffle(weights)
+    return weights / weights.sum()
+
+
+def build_customers(rng: np.random.Generator, fake: Faker, n: int, start, end, churn_rate: float):
+    names = fake_pool(fake, fake.name, n)
+    picks = rng.integers(0, len(names), n)
+    signed_up_at = random_datetimes(rng, start, np.full(n, end))
+
+    # Churned customers stop buying somewhere between sign-up and the end of the window
+    churned = rng.random(n) < churn_rate
+    last_active_at = np.where(churned, random_datetimes(rng, signed_up_at, np.full(n, end)), end)
+
+    customers = pd.DataFrame(
+        {
+            "id": random_uuids(rng, n),
+            "name": names[picks],
+            "gender": rng.choice([GenderEnum.male.value, GenderEnum.female.value], n),
+            "age": rng.integers(18, 75, n),
+            "phone_number": fake_pool(fake, fake.phone_number, n)[picks],
+            "email": [f"{name.lower().replace(' ', '.')}.{i}@example.com" for i, name in enumerate(names[picks])],
+            "address": np.char.replace(fake_pool(fake, fake.address, n), "\n", ", ")[picks],
+            "created_at": signed_up_at,
+            "updated_at": signed_up_at,
+        }
+    )
+    return customers, last_active_at
+
+
+def build_memberships(rng: np.random.Generator, customers: pd.DataFrame, member_index, membership_ids, activity):
+    # Tiers follow purchase activity, the most active tenth of members is gold
+    ranks = activity.argsort()[::-1].argsort() / len(activity)
+    tiers = np.select([ranks < 0.1, ranks < 0.4], [TierEnum.gold.value, TierEnum.silver.value], TierEnum.bronze.value)
+    start_period = customers["created_at"].to_numpy()[member_index].astype("datetime64[D]")
+    return pd.DataFrame(
+        {
+            "id": membership_ids,
+            "customer_id": customers["id"].to_numpy()[member_index],
+            "start_period": start_period.astype(str),
+            "end_period": (start_period + np.timedelta64(365, "D")).astype(str),
+            "tier": tiers,
+            "created_at": customers["created_at"].to_numpy()[member_index],
+            "updated_at": customers["created_at"].to_numpy()[member_index],
+        }
+    )
+
+
+def build_baskets(rng: np.random.Generator, customer_ids, membership_ids, dates, products: pd.DataFrame, popularity, lines_per_transaction: float):
+    n = len(dates)
+    transaction_ids = random_uuids(rng, n)
+    lines = 1 + rng.poisson(lines_per_transaction - 1, n)
+    line_transaction = np.repeat(np.arange(n), lines)
+
+    product_index = rng.choice(len(products), size=len(line_transaction), p=popularity)
+    quantities = rng.geometric(0.6, len(line_transaction))
+    prices = products["price"].to_numpy()[product_index]
+    line_totals = np.round(quantities * prices, 2)
+
+    transactions = pd.DataFrame(
+        {
+            "id": transaction_ids,
+            "customer_id": customer_ids,
+            "membership_id": membership_ids,
+            "date": dates,
+            "total_amount": np.round(np.bincount(line_transaction, weights=line_totals, minlength=n), 2),
+            "created_at": dates,
+            "updated_at": dates,
+        }
+    )
+    details = pd.DataFrame(
+        {
+            "id": random_uuids(rng, len(line_transaction)),
+            "transaction_id": transaction_ids[line_transaction],
+            "product_id": products["id"].to_numpy()[product_index],
+            "quantity": quantities,
+            "price_per_unit": prices,
+            "total_amount": line_totals,
+            "created_at": dates[line_transaction],
+            "updated_at": dates[line_transaction],
+        }
+    )
+    return transactions, details
+
+
+async def copy_frame(driver, table: str, df: pd.DataFrame):
+    # CSV through COPY FROM STDIN, pandas does the encoding in bulk
+    payload = df.to_csv(index=False, header=False, float_format="%.2f", date_format="%Y-%m-%d %H:%M:%S.%f").encode()
+    await driver.copy_to_table(table, source=io.BytesIO(payload), columns=list(df.columns), format="csv")
+    return len(df)
+
+
+async def seed(args):
+    rng = np.random.default_rng(args.seed)
+    fake = Faker()
+    fake.seed_instance(args.seed)
+
+    now = np.datetime64(args.end_date or datetime.now(), "us")
+    start = now - np.timedelta64(args.days, "D")
+    transactions_total = int(args.line_items / args.lines_per_transaction)
+    walk_ins = int(transactions_total * args.walk_in_ratio)
+    counts = dict.fromkeys(reversed(SEEDED_TABLES[1:]), 0)
+
+    async with async_engine.connect() as conn:
+        driver = (await conn.get_raw_connection()).driver_connection
+        if args.truncate:
+            await driver.execute(f"TRUNCATE {', '.join(SEEDED_TABLES)} CASCADE")
+
+        categories = build_categories(rng, fake, args.categories, now)
+        products = build_products(rng, fake, args.products, categories["id"].to_numpy(), now)
+        counts["product_categories"] += await copy_frame(driver, "product_categories", categories)
+        counts["products"] += await copy_frame(driver, "products", products)
+        popularity = product_popularity(rng, args.products, args.zipf_exponent)
+
+        customers, last_active_at = build_customers(rng, fake, args.customers, start, now, args.churn_rate)
+        counts["customers"] += await copy_frame(driver, "customers", customers)
+
+        # Purchase frequency is Pareto distributed across members, a few regulars make most of the visits
+        member_index = np.flatnonzero(rng.random(args.customers) < args.membership_ratio)
+        activity = rng.pareto(args.pareto_shape, len(member_index)) + 1
+        visits = rng.poisson((transactions_total - walk_ins) * activity / activity.sum())
+
+        # IDs are pre-allocated from the membership sequence in one round trip
+        membership_ids = np.array([row[0] for row in await driver.fetch("SELECT next_membership_id() FROM generate_series(1, $1)", len(member_index))])
+        memberships = build_memberships(rng, customers, member_index, membership_ids, activity)
+        counts["memberships"] += await copy_frame(driver, "memberships", memberships)
+
+        chunk_transactions = max(int(CHUNK_LINE_ITEMS / args.lines_per_transaction), 1)
+        customer_ids = customers["id"].to_numpy()
+        signed_up_at = customers["created_at"].to_numpy()
+
+        for chunk in np.array_split(np.arange(len(member_index)), max(visits.sum() // chunk_transactions, 1)):
+            owners = np.repeat(chunk, visits[chunk])
+            customer_index = member_index[owners]
+            dates = random_datetimes(rng, signed_up_at[customer_index], last_active_at[customer_index])
+            transactions, details = build_baskets(
+                rng, customer_ids[customer_index], membership_ids[owners], dates, products, popularity, args.lines_per_transaction
+            )
+            counts["transactions"] += await copy_frame(driver, "transactions", transactions)
+            counts["transaction_details"] += await copy_frame(driver, "transaction_details", details)
+            print(f"{counts['transactions']:,} transactions, {counts['transaction_details']:,} line items")
+
+        async with SessionLocal() as session:
+            anonymous_customer_id = await TransactionService(session).get_anonymous_customer_id()
+
+        for offset in range(0, walk_ins, chunk_transactions):
+            n = min(chunk_transactions, walk_ins - offset)
+            dates = random_datetimes(rng, start, np.full(n, now))
+            transactions, details = build_baskets(
+                rng, np.full(n, str(anonymous_customer_id)), np.full(n, None), dates, products, popularity, args.lines_per_transaction
+            )
+            counts["transactions"] += await copy_frame(driver, "transactions", transactions)
+            counts["transaction_details"] += await copy_frame(driver, "transaction_details", details)
+            print(f"{counts['transactions']:,} transactions, {counts['transaction_details']:,} line items")
+
+        # Fresh statistics for the planner and the estimated totals of the listing endpoints
+        await driver.execute(f"ANALYZE {', '.join(SEEDED_TABLES[1:])}")
+
+    return counts
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk-load a reproducible synthetic retail dataset through COPY.")
+    parser.add_argument("--preset", choices=PRESETS, default="small", help="Dataset size, individual counts below override it")
+    parser.add_argument("--customers", type=int)
+    parser.add_argument("--categories", type=int)
+    parser.add_argument("--products", type=int)
+    parser.add_argument("--line-items", type=int, help="Approximate number of transaction line items")
+    parser.add_argument("--seed", type=int, default=42, help="Same seed and options produce the same dataset")
+    parser.add_argument("--days", type=int, default=730, help="Length of the sales history")
+    parser.add_argument("--end-date", help="Last day of the sales history in YYYY-MM-DD format, defaults to now")
+    parser.add_argument("--membership-ratio", type=float, default=0.8, help="Share of customers holding a membership")
+    parser.add_argument("--walk-in-ratio", type=float, default=0.15, help="Share of transactions made by anonymous walk-ins")
+    parser.add_argument("--churn-rate", type=float, default=0.3, help="Share of customers who stop buying before the end of the window")
+    parser.add_argument("--lines-per-transaction", type=float, default=3.0, help="Mean basket size in line items")
+    parser.add_argument("--pareto-shape", type=float, default=1.5, help="Shape of the member purchase frequency distribution, lower is more skewed")
+    parser.add_argument("--zipf-exponent", type=float, default=1.1, help="Skew of product popularity")
+    parser.add_argument("--truncate", action="store_true", help="Empty the seeded tables first")
+    args = parser.parse_args(argv)
+
+    args.end_date = datetime.strptime(args.end_date, "%Y-%m-%d") if args.end_date else None
+    for name, value in PRESETS[args.preset].items():
+        if getattr(args, name) is None:
+            setattr(args, name, value)
+    return args
+
+
+def main():
+    args = parse_args()
+    started = time.time()
+    counts = asyncio.run(seed(args))
+    print(", ".join(f"{count:,} {table}" for table, count in counts.items()) + f" loaded in {time.time() - started:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
+
+# ? Run with: `python -m app.seed --preset small --truncate`
@@ -0,0 +1,548 @@
+import pandas as pd
+import numpy as np
+import joblib
+from fastapi import HTTPException
+from sqlalchemy.orm import selectinload
+from sqlalchemy.sql import func
+from sqlalchemy import delete, update
+from sqlalchemy.future import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sklearn.preprocessing import StandardScaler
+from sklearn.metrics import silhouette_score, davies_bouldin_score
+from sklearn.cluster import KMeans, DBSCAN
+from pydantic import UUID4
+from typing import List
+from decimal import Decimal
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from app.models import *
+from app.config import config
+from app.profiling import span
+from app.services import DEFAULT_MODEL_PARAMS, MEMBER_TRANSACTION, MODEL_PARAMS_FILE, RFM_FEATURES, SEGMENTATION_ALGORITHMS, segment_cache, shared_cache
+import asyncio
+import contextvars
+import json
+import os
+import tempfile
+
+# The pandas/scikit-learn half of the dashboard, app.services and app.routes import it on first use only
+
+# Batch runs save the models they fit here, inside the active model version, online scoring loads them from there
+FITTED_MODEL_DIRECTORY = "fitted"
+
+# Shared pool for CPU-bound clustering/evaluation so several algorithms can run side by side off the event loop
+segmentation_executor = ThreadPoolExecutor(max_workers=len(SEGMENTATION_ALGORITHMS), thread_name_prefix="segmentation")
+
+
+def load_model_params(algorithm: str):
+    # Hyperparameters written by the offline tuning job (app.tuning) into the active model version, if any
+    params = dict(DEFAULT_MODEL_PARAMS[algorithm])
+    params_path = os.path.join(config.MODEL_PATH, MODEL_PARAMS_FILE)
+    if os.path.exists(params_path):
+        with open(params_path) as f:
+            params.update(json.load(f).get(algorithm, {}))
+    return params
+
+
+def fitted_model_path(algorithm: AlgorithmEnum):
+    return os.path.join(config.MODEL_PATH, FITTED_MODEL_DIRECTORY, f"{AlgorithmEnum(algorithm).value}_model.pkl")
+
+
+def save_fitted_model(algorithm: AlgorithmEnum, model, scaler=None, cluster_means: pd.DataFrame = None):
+    # Written to a temporary file and renamed, so a worker reloading the model never reads a half-written pickle
+    path = fitted_model_path(algorithm)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, temporary_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            joblib.dump({"model": model, "scaler": scaler, "cluster_means": cluster_means}, f)
+        os.replace(temporary_path, path)
+    except BaseException:
+        os.unlink(temporary_path)
+        raise
+
+
+def kmeans_rfm_category(cluster: int):
+    # Assign labels based on cluster number
+    if cluster == 2:
+        return RFMCategoryEnum.occasional_customer
+    elif cluster == 1:
+        return RFMCategoryEnum.loyal_customer
+    elif cluster == 0:
+        return RFMCategoryEnum.low_value_customer
+    else:
+        return RFMCategoryEnum.others
+
+
+def assign_rfm_categories_kmeans(df_rfm: pd.DataFrame):
+    # Apply labels to clusters
+    return df_rfm["Cluster"].apply(kmeans_rfm_category)
+
+
+def dbscan_thresholds(cluster_means: pd.DataFrame):
+    # Define thresholds for labeling clusters
+    return {
+        "recency_low": cluster_means["Recency"].quantile(0.33),
+        "recency_high": cluster_means["Recency"].quantile(0.67),
+        "frequency_low": cluster_means["Frequency"].quantile(0.33),
+        "frequency_high": cluster_means["Frequency"].quantile(0.67),
+        "monetary_low": cluster_means["Monetary"].quantile(0.33),
+        "monetary_high": cluster_means["Monetary"].quantile(0.67),
+    }
+
+
+def dbscan_rfm_category(cluster: int, recency, frequency, monetary, thresholds: dict):
+    # Handle noise cluster (-1)
+    if cluster == -1:
+        return RFMCategoryEnum.noise
+
+    # Compare with thresholds to assign labels
+    if recency > thresholds["recency_low"] and frequency < thresholds["frequency_low"] and monetary < thresholds["monetary_low"]:
+        return RFMCategoryEnum.low_value_customer
+    elif recency < thresholds["recency_high"] and frequency > thresholds["frequency_high"] and monetary > thresholds["monetary_high"]:
+        return RFMCategoryEnum.loyal_customer
+    elif recency < thresholds["recency_low"] and frequency > thresholds["frequency_low"] and monetary > thresholds["monetary_low"]:
+        return RFMCategoryEnum.occasional_customer
+    else:
+        return RFMCategoryEnum.others
+
+
+def rfm_cluster_means(df_rfm: pd.DataFrame):
+    # Calculate mean RFM values for each cluster
+    return df_rfm.groupby("Cluster").agg({"Recency": "mean", "Frequency": "mean", "Monetary": "mean"}).reset_index()
+
+
+def assign_rfm_categories_dbscan(df_rfm: pd.DataFrame, cluster_means: pd.DataFrame = None):
+    if cluster_means is None:
+        cluster_means = rfm_cluster_means(df_rfm)
+    thresholds = dbscan_thresholds(cluster_means)
+
+    # Apply labels to clusters
+    return df_rfm.apply(lambda row: dbscan_rfm_category(row["Cluster"], row["Recency"], row["Frequency"], row["Monetary"], thresholds), axis=1)
+
+
+def cluster_kmeans(df_rfm: pd.DataFrame):
+    params = load_model_params(AlgorithmEnum.kmeans.value)
+    if len(df_rfm) < params["n_clusters"]:
+        raise ValueError("Not enough data points to perform KMeans clustering.")
+
+    # Work on a copy so the shared RFM frame can be clustered by several algorithms at once
+    df_segmented = df_rfm.copy()
+    kmeans = KMeans(**params, random_state=42)
+    with span("fit", rows=len(df_segmented), algorithm=AlgorithmEnum.kmeans.value):
+        df_segmented["Cluster"] = kmeans.fit_predict(df_segmented[RFM_FEATURES])
+    with span("label", rows=len(df_segmented), algorithm=AlgorithmEnum.kmeans.value):
+        df_segmented["RFMCategory"] = assign_rfm_categories_kmeans(df_segmented)
+    save_fitted_model(AlgorithmEnum.kmeans, kmeans)
+    return df_segmented
+
+
+def cluster_dbscan(df_rfm: pd.DataFrame):
+    df_segmented = df_rfm.copy()
+    scaler = StandardScaler()
+    with span("scale", rows=len(df_segmented), algorithm=AlgorithmEnum.dbscan.value):
+        rfm_scaled = scaler.fit_transform(df_segmented[RFM_FEATURES])
+
+    dbscan = DBSCAN(**load_model_params(AlgorithmEnum.dbscan.value))
+    with span("fit", rows=len(df_segmented), algorithm=AlgorithmEnum.dbscan.value):
+        df_segmented["Cluster"] = dbscan.fit_predict(rfm_scaled)
+    with span("label", rows=len(df_segmented), algorithm=AlgorithmEnum.dbscan.value):
+        # Kept with the model so online scoring labels with this run's thresholds, noise cluster included
+        cluster_means = rfm_cluster_means(df_segmented)
+        df_segmented["RFMCategory"] = assign_rfm_categories_dbscan(df_segmented, cluster_means)
+    save_fitted_model(AlgorithmEnum.dbscan, dbscan, scaler, cluster_means)
+    return df_segmented
+
+
+CLUSTERING_FUNCTIONS = {
+    AlgorithmEnum.kmeans.value: cluster_kmeans,
+    AlgorithmEnum.dbscan.value: cluster_dbscan,
+}
+
+
+def summarize_segmentation(segmented_data: pd.DataFrame, algorithm):
+    # Group by RFMCategory and calculate count and total revenue
+    result = segmented_data.groupby("RFMCategory").agg(count=("CustomerID", "size"), total_revenue=("Monetary", "sum")).reset_index()
+
+    # Convert Decimal to float
+    result["total_revenue"] = result["total_revenue"].apply(lambda x: float(x) if isinstance(x, Decimal) else x)
+
+    # if any category is missing, add it with 0 count and revenue
+    missing_categories = [category.value for category in RFMCategoryEnum if category.value not in result["RFMCategory"].values]
+
+    for category in missing_categories:
+        missing_category = pd.DataFrame({"RFMCategory": [category], "count": [0], "total_revenue": [0]})
+        result = pd.concat([result, missing_category], ignore_index=True)
+
+    result = result.rename(columns={"RFMCategory": "rfm_category"})
+
+    # Calculate silhouette score and Davies-Bouldin index
+    rfm_values = segmented_data[RFM_FEATURES]
+    clusters = segmented_data["Cluster"]
+    with span("evaluation", rows=len(segmented_data), algorithm=AlgorithmEnum(algorithm).value):
+        silhouette_avg = silhouette_score(rfm_values, clusters)
+        db_index = davies_bouldin_score(rfm_values, clusters)
+
+    return {
+        "algorithm": algorithm,
+        "segmentation": result.to_dict(orient="records"),
+        "evaluation": {"silhouette_score": silhouette_avg, "davies_bouldin_index": db_index},
+    }
+
+
+class SegmentationService:
+    def __init__(self, db: AsyncSession, read_db: AsyncSession = None):
+        self.db = db
+        # The scans may run on a read replica, results are always written through db
+        self.read_db = read_db or db
+        self.df_rfm = None
+        self.segmented_data = None
+        self.algorithm = None
+        self.start_date = None
+        self.end_date = None
+
+    async def load_existing_results(self, algorithm: str):
+        with span("load_results", algorithm=AlgorithmEnum(algorithm).value) as load_span:
+            result = await self.read_db.execute(select(SegmentationResult).where(SegmentationResult.algorithm == algorithm))
+            existing_results = result.scalars().all()
+            load_span.set_rows(len(existing_results))
+        if not existing_results:
+            return None
+
+        return pd.DataFrame(
+            [
+                {
+                    "CustomerID": result.customer_id,
+                    "RFMCategory": result.rfm_category,
+                    "Cluster": result.cluster,
+                    "Recency": result.recency,
+                    "Frequency": result.frequency,
+                    "Monetary": result.monetary,
+                }
+                for result in existing_results
+            ]
+        )
+
+    async def anonymous_summary(self, start_date: datetime = None, end_date: datetime = None):
+        # Walk-in sales are kept out of clustering and only reported as one aggregate
+        query = select(func.count(Transaction.id), func.sum(Transaction.total_amount)).where(Transaction.membership_id.is_(None))
+        if start_date:
+            query = query.filter(Transaction.date >= start_date)
+        if end_date:
+            query = query.filter(Transaction.date <= end_date)
+        result = await self.read_db.execute(query)
+        transactions, total_revenue = result.one()
+        return {"transactions": transactions, "total_revenue": float(total_revenue or 0)}
+
+    async def preprocess(self, start_date: datetime = None, end_date: datetime = None, num_batches: int = 20, algorithm: str = "kmeans"):
+        self.start_date = start_date
+        self.end_date = end_date
+
+        # Check if there are existing segmentation results for the algorithm
+        algorithm = algorithm.lower()
+        existing_results = await self.load_existing_results(algorithm)
+
+        if existing_results is not None:
+            # Load existing segmentation results
+            self.segmented_data = existing_results
+            self.algorithm = algorithm
+            return
+
+        await self.compute_rfm(start_date=start_date, end_date=end_date, num_batches=num_batches)
+
+    async def compute_rfm(self, start_date: datetime = None, end_date: datetime = None, num_batches: int = 20, use_cache: bool = True):
+        # Shared by the workers: concurrent requests for the same window wait for one computation, use_cache=False recomputes
+        self.df_rfm = await shared_cache.get_or_compute(
+            f"rfm:{start_date}:{end_date}",
+            lambda: self.build_rfm(start_date, end_date, num_batches),
+            config.rfm_cache_ttl,
+            refresh=not use_cache,
+        )
+
+    async def build_rfm(self, start_date: datetime = None, end_date: datetime = None, num_batches: int = 20):
+        all_data = []
+
+        # Get the total number of transactions, walk-in sales have no membership and are reported separately
+        total_transactions_query = select(func.count(Transaction.id)).where(MEMBER_TRANSACTION)
+        if start_date:
+            total_transactions_query = total_transactions_query.filter(Transaction.date >= start_date)
+        if end_date:
+            total_transactions_query = total_transactions_query.filter(Transaction.date <= end_date)
+        with span("count_transactions") as count_span:
+            total_transactions_result = await self.read_db.execute(total_transactions_query)
+            total_transactions = total_transactions_result.scalar()
+            count_span.set_rows(total_transactions)
+
+        # Calculate the batch size based on the total number of transactions and the desired number of batches
+        batch_size = (total_transactions + num_batches - 1) // num_batches
+
+        for batch_num in range(num_batches):
+            query = (
+                select(Transaction)
+                .options(selectinload(Transaction.transaction_details))
+                .where(MEMBER_TRANSACTION)
+                .limit(batch_size)
+                .offset(batch_num * batch_size)
+            )
+            if start_date:
+                query = query.filter(Transaction.date >= start_date)
+            if end_date:
+                query = query.filter(Transaction.date <= end_date)
+            with span("fetch_batch", batch=f"{batch_num + 1}/{num_batches}") as batch_span:
+                result = await self.read_db.execute(query)
+                transactions = result.scalars().all()
+
+                data = [
+                    {
+                        "CustomerID": t.customer_id,
+                        "InvoiceNo": t.id,
+                        "Quantity": td.quantity,
+                        "UnitPrice": td.price_per_unit,
+                        "Date": t.date,
+                    }
+                    for t in transactions
+                    for td in t.transaction_details
+                ]
+                batch_span.set_rows(len(data))
+
+            if not transactions:
+                break
+
+            all_data.extend(data)
+
+        if not all_data:
+            raise HTTPException(status_code=404, detail="No transactions found.")
+
+        with span("build_dataframe", rows=len(all_data)):
+            df = pd.DataFrame(all_data)
+
+        # Data cleaning
+        with span("clean") as clean_span:
+            df = df[df["CustomerID"].notna()]
+            df = df[df["Quantity"] > 0]
+            df = df[df["UnitPrice"] > 0]
+            df["Revenue"] = df["Quantity"] * df["UnitPrice"]
+            clean_span.set_rows(len(df))
+
+        # Feature engineering
+        with span("rfm_features") as rfm_span:
+            if end_date is None:
+                end_date = datetime.now()
+            df["Recency"] = (end_date - df["Date"]).dt.days
+            df_rfm = (
+                df.groupby("CustomerID")
+                .agg({"Recency": "min", "InvoiceNo": "count", "Revenue": "sum"})
+                .rename(columns={"InvoiceNo": "Frequency", "Revenue": "Monetary"})
+            ).reset_index()
+            rfm_span.set_rows(len(df_rfm))
+
+        return df_rfm
+
+    async def with_kmeans(self):
+        if self.df_rfm is None:
+            raise ValueError("Data not preprocessed. Call preprocess() first.")
+
+        # Fit KMeans on the entire dataset
+        self.df_rfm = cluster_kmeans(self.df_rfm)
+        self.segmented_data = self.df_rfm.copy()
+        self.algorithm = AlgorithmEnum.kmeans
+
+        await self.save_segmentation_results()
+
+    async def with_dbscan(self):
+        if self.df_rfm is None:
+            raise ValueError("Data not preprocessed. Call preprocess() first.")
+
+        # Fit DBSCAN on the entire dataset
+        self.df_rfm = cluster_dbscan(self.df_rfm)
+        self.segmented_data = self.df_rfm.copy()
+        self.algorithm = AlgorithmEnum.dbscan
+
+        await self.save_segmentation_results()
+
+    async def with_algorithms(
+        self, algorithms: List[str], start_date: datetime = None, end_date: datetime = None, num_batches: int = 20, force: bool = False
+    ):
+        loop = asyncio.get_running_loop()
+        segmented = {}
+        pending = []
+
+        # Reuse stored results where available, only the remaining algorithms need fresh RFM features
+        for algorithm in algorithms:
+            existing_results = None if force else await self.load_existing_results(algorithm)
+            if existing_results is not None:
+                segmented[algorithm] = existing_results
+            else:
+                pending.append(algorithm)
+
+        if pending:
+            # Compute RFM once and fit every pending algorithm concurrently on the shared feature matrix
+            await self.compute_rfm(start_date=start_date, end_date=end_date, num_batches=num_batches, use_cache=not force)
+            # Each job runs in a copy of the request context so its spans land in the request's trace
+            fitted = await asyncio.gather(
+                *(
+                    loop.run_in_executor(segmentation_executor, contextvars.copy_context().run, CLUSTERING_FUNCTIONS[algorithm], self.df_rfm)
+                    for algorithm in pending
+                )
+            )
+
+            # The session is not safe for concurrent use, so results are saved one algorithm at a time
+            for algorithm, df_segmented in zip(pending, fitted):
+                segmented[algorithm] = df_segmented
+                await self.save_segmentation_results(df_segmented, AlgorithmEnum(algorithm))
+
+        summaries = await asyncio.gather(
+            *(
+                loop.run_in_executor(segmentation_executor, contextvars.copy_context().run, summarize_segmentation, segmented[algorithm], algorithm)
+                for algorithm in algorithms
+            )
+        )
+        anonymous = await self.anonymous_summary(start_date, end_date)
+        return {"results": [{**summary, "anonymous": anonymous} for summary in summaries]}
+
+    async def save_segmentation_results(self, df_segmented: pd.DataFrame = None, algorithm: AlgorithmEnum = None):
+        df_segmented = self.df_rfm if df_segmented is None else df_segmented
+        algorithm = algorithm or self.algorithm
+
+        with span("save", rows=len(df_segmented), algorithm=AlgorithmEnum(algorithm).value):
+            # Replace the algorithm's results in a single transaction, readers and online scoring never see a half-written set
+            await self.db.execute(delete(SegmentationResult).where(SegmentationResult.algorithm == algorithm))
+
+            # Save new segmentation results
+            segmentation_results = [
+                SegmentationResult(
+                    customer_id=row["CustomerID"],
+                    rfm_category=row["RFMCategory"],
+                    cluster=row["Cluster"],
+                    recency=row["Recency"],
+                    frequency=row["Frequency"],
+                    monetary=row["Monetary"],
+                    algorithm=algorithm,
+                    created_at=datetime.now(),
+                    updated_at=datetime.now(),
+                )
+                for _, row in df_segmented.iterrows()
+            ]
+            self.db.add_all(segmentation_results)
+            await self.db.commit()
+        segment_cache.clear(lambda key: key[0] == AlgorithmEnum(algorithm))
+
+    async def result(self):
+        if self.segmented_data is None:
+            raise ValueError("Segmentation not performed. Call with_kmeans() or with_dbscan() first.")
+
+        summary = summarize_segmentation(self.segmented_data, self.algorithm)
+        summary["anonymous"] = await self.anonymous_summary(self.start_date, self.end_date)
+        return summary
+
+
+class OnlineScoringService:
+    # Keeps a single customer's segment fresh after a purchase by scoring it against the models the last batch run fitted
+    def __init__(self, db: AsyncSession):
+        self.db = db
+
+    async def score_customer(self, customer_id: UUID4, transaction_date: datetime, quantities: List[int], unit_prices: List[float]):
+        models = load_scoring_models()
+        if not models:
+            return
+
+        result = await self.db.execute(select(SegmentationResult).where(SegmentationResult.customer_id == customer_id))
+        existing_results = {AlgorithmEnum(row.algorithm): row for row in result.scalars().all()}
+        if not existing_results:
+            return
+
+        # Same cleaning as the batch pipeline: only positive quantity and price lines count towards RFM
+        lines = [(quantity, unit_price) for quantity, unit_price in zip(quantities, unit_prices) if quantity > 0 and unit_price > 0]
+        if not lines:
+            return
+
+        now = datetime.now()
+        for algorithm, model in models.items():
+            # Only rows written by a batch run are refreshed, new customers and never-segmented algorithms wait for the next batch
+            existing_result = existing_results.get(algorithm)
+            if existing_result is None:
+                continue
+
+            recency, frequency, monetary = incremental_rfm(existing_result, now, transaction_date, lines)
+            cluster, rfm_category = model.score(recency, frequency, monetary)
+            await self.db.execute(
+                update(SegmentationResult)
+                .where(SegmentationResult.id == existing_result.id)
+                .values(rfm_category=rfm_category, cluster=cluster, recency=recency, frequency=frequency, monetary=monetary, updated_at=now)
+            )
+        await self.db.commit()
+
+        # Only after the commit, a request missing the cache earlier would re-cache the old row
+        for algorithm in models:
+            segment_cache.delete((algorithm, customer_id))
+
+
+def incremental_rfm(existing_result: SegmentationResult, now: datetime, transaction_date: datetime, lines: List[tuple]):
+    # Recency is stored relative to the last update, so it ages by the days elapsed since then
+    recency = max((now - transaction_date).days, 0)
+    frequency = len(lines)
+    monetary = sum(Decimal(str(quantity)) * Decimal(str(unit_price)) for quantity, unit_price in lines)
+    if existing_result is not None:
+        recency = min(existing_result.recency + (now - existing_result.updated_at).days, recency)
+        frequency += existing_result.frequency
+        monetary += existing_result.monetary
+    return recency, frequency, monetary
+
+
+class ScoringModel:
+    # Plain numpy nearest-center/core-sample lookup, a single row through sklearn's predict costs far more in input validation
+    def __init__(self, algorithm: AlgorithmEnum, model, scaler, cluster_means: pd.DataFrame = None):
+        self.algorithm = algorithm
+        if algorithm == AlgorithmEnum.kmeans:
+            self.mean = np.zeros(len(RFM_FEATURES))
+            self.scale = np.ones(len(RFM_FEATURES))
+            self.points = model.cluster_centers_
+            self.labels = np.arange(len(model.cluster_centers_))
+            self.max_distance = np.inf
+            self.thresholds = None
+        else:
+            # DBSCAN has no predict(): a point joins the cluster of its nearest core sample within eps, otherwise it is noise
+            self.mean = scaler.mean_
+            self.scale = scaler.scale_
+            self.points = model.components_
+            self.labels = model.labels_[model.core_sample_indices_]
+            self.max_distance = model.eps
+            self.thresholds = dbscan_thresholds(cluster_means)
+
+    def score(self, recency: int, frequency: int, monetary: Decimal):
+        cluster = -1
+        if len(self.points):
+            vector = (np.array([recency, frequency, float(monetary)]) - self.mean) / self.scale
+            distances = ((self.points - vector) ** 2).sum(axis=1)
+            nearest = distances.argmin()
+            if distances[nearest] <= self.max_distance**2:
+                cluster = int(self.labels[nearest])
+
+        if self.algorithm == AlgorithmEnum.kmeans:
+            rfm_category = kmeans_rfm_category(cluster)
+        else:
+            rfm_category = dbscan_rfm_category(cluster, recency, frequency, float(monetary), self.thresholds)
+        return cluster, rfm_category.value
+
+
+# algorithm -> (file mtime, ScoringModel)
+scoring_models = {}
+
+
+def load_scoring_models():
+    # One stat per algorithm, so every worker picks up the models of a batch run made by any other worker on its next call
+    models = {}
+    for algorithm in AlgorithmEnum:
+        path = fitted_model_path(algorithm)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            # Never batch-segmented, there are no results to keep fresh either
+            continue
+
+        loaded = scoring_models.get(algorithm)
+        if loaded is None or loaded[0] != mtime:
+            loaded = (mtime, ScoringModel(algorithm, **joblib.load(path)))
+            scoring_models[algorithm] = loaded
+        models[algorithm] = loaded[1]
+    return models
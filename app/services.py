@@ -1,276 +1,44 @@
-import pandas as pd
-from fastapi import HTTPException
-from sqlalchemy.orm import selectinload
 from sqlalchemy.sql import func
-from sqlalchemy import delete
+from sqlalchemy import Integer, column, update, values
+from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.future import select
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.ext.asyncio import AsyncSession
-from sklearn.preprocessing import StandardScaler
-from sklearn.metrics import silhouette_score, davies_bouldin_score
-from sklearn.cluster import KMeans, DBSCAN
 from pydantic import UUID4
 from passlib.context import CryptContext
 from decimal import Decimal
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from app.schemas import *
 from app.models import *
-from app.utils import error_response
-import pickle
-import os
+from app.utils import error_response, apply_keyset, next_page_cursor, estimate_count, compute_etag
+from app.config import config
+from app.cache import TTLCache, MISSING, create_shared_cache
+from app.security import create_access_token
+from app.db import read_session_factory
+import asyncio
+import csv
+import io
+import orjson
+import uuid
+import zlib
 
 
 # region DASHBOARD
-CACHE_FILE = "segmentation_cache.pkl"
+RFM_FEATURES = ["Recency", "Frequency", "Monetary"]
+MEMBER_TRANSACTION = Transaction.membership_id.isnot(None)
+SEGMENTATION_ALGORITHMS = [algorithm.value for algorithm in AlgorithmEnum]
+MODEL_PARAMS_FILE = "params.json"
+DEFAULT_MODEL_PARAMS = {
+    AlgorithmEnum.kmeans.value: {"n_clusters": 3},
+    AlgorithmEnum.dbscan.value: {"eps": 0.5, "min_samples": 5},
+}
 
+# Hot per-customer segment lookups keyed by (algorithm, customer_id), dropped whenever a segmentation run rewrites the results
+segment_cache = TTLCache(maxsize=config.segment_cache_size, ttl=config.segment_cache_ttl)
 
-class SegmentationService:
-    def __init__(self, db: AsyncSession):
-        self.db = db
-        self.df_rfm = None
-        self.segmented_data = None
-        self.algorithm = None
-
-    async def preprocess(self, start_date: datetime = None, end_date: datetime = None, num_batches: int = 20, algorithm: str = "kmeans"):
-        # Check if there are existing segmentation results for the algorithm
-        algorithm = algorithm.lower()
-        existing_results = await self.db.execute(select(SegmentationResult).where(SegmentationResult.algorithm == algorithm))
-        existing_results = existing_results.scalars().all()
-
-        if existing_results:
-            # Load existing segmentation results
-            self.segmented_data = pd.DataFrame(
-                [
-                    {
-                        "CustomerID": result.customer_id,
-                        "RFMCategory": result.rfm_category,
-                        "Cluster": result.cluster,
-                        "Recency": result.recency,
-                        "Frequency": result.frequency,
-                        "Monetary": result.monetary,
-                    }
-                    for result in existing_results
-                ]
-            )
-            self.algorithm = algorithm
-            return
-
-        all_data = []
-        start_batch = 0
-
-        # Get the total number of transactions
-        total_transactions_query = select(func.count(Transaction.id))
-        if start_date:
-            total_transactions_query = total_transactions_query.filter(Transaction.date >= start_date)
-        if end_date:
-            total_transactions_query = total_transactions_query.filter(Transaction.date <= end_date)
-        total_transactions_result = await self.db.execute(total_transactions_query)
-        total_transactions = total_transactions_result.scalar()
-
-        # Calculate the batch size based on the total number of transactions and the desired number of batches
-        batch_size = (total_transactions + num_batches - 1) // num_batches
-
-        # Check if there is cached data
-        if os.path.exists(CACHE_FILE):
-            with open(CACHE_FILE, "rb") as f:
-                all_data = pickle.load(f)
-                start_batch = len(all_data) // batch_size
-
-        for batch_num in range(start_batch, num_batches):
-            print(f"Processing batch {batch_num + 1}/{num_batches}...")
-            print(f"Total data: {total_transactions}, Processed data: {len(all_data)}")
-            query = select(Transaction).options(selectinload(Transaction.transaction_details)).limit(batch_size).offset(batch_num * batch_size)
-            if start_date:
-                query = query.filter(Transaction.date >= start_date)
-            if end_date:
-                query = query.filter(Transaction.date <= end_date)
-            result = await self.db.execute(query)
-            transactions = result.scalars().all()
-
-            if not transactions:
-                break
-
-            data = [
-                {
-                    "CustomerID": t.customer_id,
-                    "InvoiceNo": t.id,
-                    "Quantity": td.quantity,
-                    "UnitPrice": td.price_per_unit,
-                    "Date": t.date,
-                }
-                for t in transactions
-                for td in t.transaction_details
-            ]
-            all_data.extend(data)
-
-            # Cache the intermediate results
-            with open(CACHE_FILE, "wb") as f:
-                pickle.dump(all_data, f)
-
-        if not all_data:
-            raise HTTPException(status_code=404, detail="No transactions found.")
-
-        df = pd.DataFrame(all_data)
-
-        # Data cleaning
-        df = df[df["CustomerID"].notna()]
-        df = df[df["Quantity"] > 0]
-        df = df[df["UnitPrice"] > 0]
-        df["Revenue"] = df["Quantity"] * df["UnitPrice"]
-
-        # Feature engineering
-        if end_date is None:
-            end_date = datetime.now()
-        df["Recency"] = (end_date - df["Date"]).dt.days
-        df_rfm = (
-            df.groupby("CustomerID")
-            .agg({"Recency": "min", "InvoiceNo": "count", "Revenue": "sum"})
-            .rename(columns={"InvoiceNo": "Frequency", "Revenue": "Monetary"})
-        ).reset_index()
-
-        self.df_rfm = df_rfm
-
-    async def with_kmeans(self):
-        if self.df_rfm is None:
-            raise ValueError("Data not preprocessed. Call preprocess() first.")
-
-        if len(self.df_rfm) < 3:
-            raise ValueError("Not enough data points to perform KMeans clustering.")
-
-        # Fit KMeans on the entire dataset
-        kmeans = KMeans(n_clusters=3, random_state=42)
-        self.df_rfm["Cluster"] = kmeans.fit_predict(self.df_rfm[["Recency", "Frequency", "Monetary"]])
-
-        self.assign_rfm_categories_kmeans()
-        self.segmented_data = self.df_rfm.copy()
-        self.algorithm = AlgorithmEnum.kmeans
-
-        await self.save_segmentation_results()
-
-    async def with_dbscan(self):
-        if self.df_rfm is None:
-            raise ValueError("Data not preprocessed. Call preprocess() first.")
-
-        rfm_scaled = StandardScaler().fit_transform(self.df_rfm[["Recency", "Frequency", "Monetary"]])
-
-        # Fit DBSCAN on the entire dataset
-        dbscan = DBSCAN(eps=0.5, min_samples=5)
-        self.df_rfm["Cluster"] = dbscan.fit_predict(rfm_scaled)
-
-        self.assign_rfm_categories_dbscan()
-        self.segmented_data = self.df_rfm.copy()
-        self.algorithm = AlgorithmEnum.dbscan
-
-        await self.save_segmentation_results()
-
-    def assign_rfm_categories_kmeans(self):
-        # Define cluster labels based on RFM statistics
-        def assign_labels(row):
-            cluster = row["Cluster"]
-
-            # Assign labels based on cluster number
-            if cluster == 2:
-                return RFMCategoryEnum.occasional_customer
-            elif cluster == 1:
-                return RFMCategoryEnum.loyal_customer
-            elif cluster == 0:
-                return RFMCategoryEnum.low_value_customer
-            else:
-                return RFMCategoryEnum.others
-
-        # Apply labels to clusters
-        self.df_rfm["RFMCategory"] = self.df_rfm.apply(assign_labels, axis=1)
-
-    def assign_rfm_categories_dbscan(self):
-        # Calculate mean RFM values for each cluster
-        cluster_means = self.df_rfm.groupby("Cluster").agg({"Recency": "mean", "Frequency": "mean", "Monetary": "mean"}).reset_index()
-
-        # Define thresholds for labeling clusters
-        recency_threshold_low = cluster_means["Recency"].quantile(0.33)
-        recency_threshold_high = cluster_means["Recency"].quantile(0.67)
-        frequency_threshold_low = cluster_means["Frequency"].quantile(0.33)
-        frequency_threshold_high = cluster_means["Frequency"].quantile(0.67)
-        monetary_threshold_low = cluster_means["Monetary"].quantile(0.33)
-        monetary_threshold_high = cluster_means["Monetary"].quantile(0.67)
-
-        # Define cluster labels based on RFM statistics
-        def assign_labels(row):
-            cluster = row["Cluster"]
-
-            # Handle noise cluster (-1)
-            if cluster == -1:
-                return RFMCategoryEnum.noise
-
-            # Extract mean RFM values for the cluster
-            recency = row["Recency"]
-            frequency = row["Frequency"]
-            monetary = row["Monetary"]
-
-            # Compare with thresholds to assign labels
-            if recency > recency_threshold_low and frequency < frequency_threshold_low and monetary < monetary_threshold_low:
-                return RFMCategoryEnum.low_value_customer
-            elif recency < recency_threshold_high and frequency > frequency_threshold_high and monetary > monetary_threshold_high:
-                return RFMCategoryEnum.loyal_customer
-            elif recency < recency_threshold_low and frequency > frequency_threshold_low and monetary > monetary_threshold_low:
-                return RFMCategoryEnum.occasional_customer
-            else:
-                return RFMCategoryEnum.others
-
-        # Apply labels to clusters
-        self.df_rfm["RFMCategory"] = self.df_rfm.apply(assign_labels, axis=1)
-
-    async def save_segmentation_results(self):
-        # Clear existing segmentation results for the current algorithm
-        await self.db.execute(delete(SegmentationResult).where(SegmentationResult.algorithm == self.algorithm))
-        await self.db.commit()
-
-        # Save new segmentation results
-        segmentation_results = [
-            SegmentationResult(
-                customer_id=row["CustomerID"],
-                rfm_category=row["RFMCategory"],
-                cluster=row["Cluster"],
-                recency=row["Recency"],
-                frequency=row["Frequency"],
-                monetary=row["Monetary"],
-                algorithm=self.algorithm,
-                created_at=datetime.now(),
-                updated_at=datetime.now(),
-            )
-            for _, row in self.df_rfm.iterrows()
-        ]
-        self.db.add_all(segmentation_results)
-        await self.db.commit()
-
-    async def result(self):
-        if self.segmented_data is None:
-            raise ValueError("Segmentation not performed. Call with_kmeans() or with_dbscan() first.")
-
-        # Group by RFMCategory and calculate count and total revenue
-        result = self.segmented_data.groupby("RFMCategory").agg(count=("CustomerID", "size"), total_revenue=("Monetary", "sum")).reset_index()
-
-        # Convert Decimal to float
-        result["total_revenue"] = result["total_revenue"].apply(lambda x: float(x) if isinstance(x, Decimal) else x)
-
-        # if any category is missing, add it with 0 count and revenue
-        missing_categories = [category.value for category in RFMCategoryEnum if category.value not in result["RFMCategory"].values]
-
-        for category in missing_categories:
-            missing_category = pd.DataFrame({"RFMCategory": [category], "count": [0], "total_revenue": [0]})
-            result = pd.concat([result, missing_category], ignore_index=True)
-
-        result = result.rename(columns={"RFMCategory": "rfm_category"})
-
-        # Calculate silhouette score and Davies-Bouldin index
-        rfm_values = self.segmented_data[["Recency", "Frequency", "Monetary"]]
-        clusters = self.segmented_data["Cluster"]
-        silhouette_avg = silhouette_score(rfm_values, clusters)
-        db_index = davies_bouldin_score(rfm_values, clusters)
-
-        return {
-            "algorithm": self.algorithm,
-            "segmentation": result.to_dict(orient="records"),
-            "evaluation": {"silhouette_score": silhouette_avg, "davies_bouldin_index": db_index},
-        }
+# RFM features and dashboard metrics, computed once for all workers instead of once per worker
+shared_cache = create_shared_cache(config.shared_cache_backend)
 
 
 class DashboardService:
@@ -278,6 +46,13 @@ class DashboardService:
         self.db = db
 
     async def get_dashboard_metrics(self, start_date: datetime = None, end_date: datetime = None):
+        if config.dashboard_cache_ttl <= 0:
+            return await self.compute_dashboard_metrics(start_date, end_date)
+        return await shared_cache.get_or_compute(
+            f"dashboard_metrics:{start_date}:{end_date}", lambda: self.compute_dashboard_metrics(start_date, end_date), config.dashboard_cache_ttl
+        )
+
+    async def compute_dashboard_metrics(self, start_date: datetime = None, end_date: datetime = None):
         # Total sales
         query = select(func.sum(Transaction.total_amount))
         if start_date:
@@ -317,7 +92,7 @@ class DashboardService:
             "total_memberships": total_memberships,
         }
 
-    async def get_dashboard_segmentation(self, segmentation_service: SegmentationService):
+    async def get_dashboard_segmentation(self, segmentation_service: "SegmentationService"):
         segmentation_result = await segmentation_service.result()
         return {
             "algorithm": segmentation_result["algorithm"],
@@ -330,24 +105,57 @@ class DashboardService:
 
 
 # region PRODUCTS
+async def paginate(db: AsyncSession, query, rows: list, limit: int, with_total: bool = False, key=lambda row: row):
+    pagination = {"limit": limit, "next_cursor": next_page_cursor(rows, limit, key)}
+    if with_total:
+        pagination["total_estimate"] = await estimate_count(db, query)
+    return pagination
+
+
+# Read-through cache for the catalog, POS terminals poll it constantly while it rarely changes.
+# Product writes clear it, other workers see changes once their entries expire.
+catalog_cache = TTLCache(maxsize=config.catalog_cache_size, ttl=config.catalog_cache_ttl)
+
+
 class ProductService:
     def __init__(self, db: AsyncSession):
         self.db = db
 
-    async def get_product_categories(self, limit: int, offset: int):
-        result = await self.db.execute(select(ProductCategory).limit(limit).offset(offset))
-        categories = result.scalars().all()
-        return [ProductCategorySchema.model_validate(category) for category in categories]
-
-    async def get_products(self, limit: int, offset: int):
-        result = await self.db.execute(select(Product).where(Product.deleted == False).limit(limit).offset(offset))
-        products = result.scalars().all()
-        return [ProductSchema.model_validate(product) for product in products]
+    async def read_through(self, key: tuple, load):
+        entry = catalog_cache.get(key)
+        if entry is MISSING:
+            data = await load()
+            entry = (*data, compute_etag(*data))
+            catalog_cache.set(key, entry)
+        return entry
+
+    async def get_product_categories(self, limit: int, offset: int = 0, cursor: str = None, with_total: bool = False):
+        async def load():
+            query = select(ProductCategory)
+            result = await self.db.execute(apply_keyset(query, ProductCategory, limit, cursor, offset))
+            categories = result.scalars().all()
+            pagination = await paginate(self.db, query, categories, limit, with_total)
+            return [ProductCategorySchema.model_validate(category) for category in categories[:limit]], pagination
+
+        return await self.read_through(("product_categories", limit, offset, cursor, with_total), load)
+
+    async def get_products(self, limit: int, offset: int = 0, cursor: str = None, with_total: bool = False):
+        async def load():
+            query = select(Product).where(Product.deleted == False)
+            result = await self.db.execute(apply_keyset(query, Product, limit, cursor, offset))
+            products = result.scalars().all()
+            pagination = await paginate(self.db, query, products, limit, with_total)
+            return [ProductSchema.model_validate(product) for product in products[:limit]], pagination
+
+        return await self.read_through(("products", limit, offset, cursor, with_total), load)
 
     async def get_product(self, product_id: UUID4):
-        result = await self.db.execute(select(Product).filter_by(id=product_id, deleted=False))
-        product = result.scalars().first()
-        return ProductSchema.model_validate(product)
+        async def load():
+            result = await self.db.execute(select(Product).filter_by(id=product_id, deleted=False))
+            product = result.scalars().first()
+            return (ProductSchema.model_validate(product) if product else None,)
+
+        return await self.read_through(("product", product_id), load)
 
     async def create_product(self, product: ProductCreate):
         new_product = Product(
@@ -363,6 +171,7 @@ class ProductService:
         self.db.add(new_product)
         await self.db.commit()
         await self.db.refresh(new_product)
+        catalog_cache.clear()
         return ProductSchema.model_validate(new_product)
 
     async def update_product(self, product_id: UUID4, product: ProductUpdate):
@@ -378,6 +187,7 @@ class ProductService:
             existing_product.updated_at = datetime.now()
             await self.db.commit()
             await self.db.refresh(existing_product)
+            catalog_cache.clear()
             return ProductSchema.model_validate(existing_product)
         else:
             return None
@@ -391,6 +201,7 @@ class ProductService:
             product.updated_at = datetime.now()
             await self.db.commit()
             await self.db.refresh(product)
+            catalog_cache.clear()
             return ProductSchema.model_validate(product)
         else:
             return None
@@ -400,16 +211,24 @@ class ProductService:
 
 
 # region AUTHENTICATION
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+# bcrypt is slow by design, hashing runs in a bounded pool (bcrypt releases the GIL) so logins never block the event loop
+password_executor = ThreadPoolExecutor(max_workers=config.password_hash_concurrency, thread_name_prefix="password-hash")
+
+
 class AuthService:
     def __init__(self, db: AsyncSession):
         self.db = db
-        self.pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+        self.pwd_context = pwd_context
 
-    def verify_password(self, plain_password, hashed_password):
-        return self.pwd_context.verify(plain_password, hashed_password)
+    async def verify_password(self, plain_password, hashed_password):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(password_executor, self.pwd_context.verify, plain_password, hashed_password)
 
-    def get_password_hash(self, password):
-        return self.pwd_context.hash(password)
+    async def get_password_hash(self, password):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(password_executor, self.pwd_context.hash, password)
 
     async def is_user_exists(self, username: str):
         result = await self.db.execute(select(Account).filter(Account.username == username))
@@ -420,7 +239,7 @@ class AuthService:
         if await self.is_user_exists(user.username):
             return None
 
-        hashed_password = self.get_password_hash(user.password)
+        hashed_password = await self.get_password_hash(user.password)
         db_user = Account(
             username=user.username,
             password=hashed_password,
@@ -436,49 +255,93 @@ class AuthService:
     async def login_user(self, user: UserLogin):
         result = await self.db.execute(select(Account).filter(Account.username == user.username))
         db_user = result.scalars().first()
-        if not db_user or not self.verify_password(user.password, db_user.password):
+        if not db_user or not await self.verify_password(user.password, db_user.password):
             return None
-        return db_user
+
+        # Clients send the access token on later calls instead of the password, sparing a bcrypt round per request
+        access_token, expires_at = create_access_token(db_user.id, db_user.username, RoleEnum(db_user.role).value)
+        return LoginSchema(**UserSchema.model_validate(db_user).model_dump(), access_token=access_token, expires_at=expires_at)
 
 
 # endregion
 
 
 # region TRANSACTION
+ANONYMOUS_CUSTOMER_ID = uuid.UUID("00000000-0000-4000-8000-000000000000")
+ANONYMOUS_CUSTOMER_EMAIL = "anonymous@example.com"
+anonymous_customer_id = None
+
+TRANSACTION_LISTING_COLUMNS = [getattr(Transaction, field) for field in TransactionSchema.model_fields]
+TRANSACTION_DETAIL_LISTING_COLUMNS = [getattr(TransactionDetail, field) for field in TransactionDetailSchema.model_fields]
+
+
 class TransactionService:
     def __init__(self, db: AsyncSession):
         self.db = db
 
-    async def get_all_transactions(self, limit: int, offset: int):
-        result = await self.db.execute(select(Transaction).options(selectinload(Transaction.transaction_details)).limit(limit).offset(offset))
-        transactions = result.scalars().all()
-        return [TransactionSchema.model_validate(transaction) for transaction in transactions]
+    async def get_all_transactions(self, limit: int, offset: int = 0, cursor: str = None, with_total: bool = False, expand_details: bool = False):
+        # Only the columns TransactionSchema serializes, as plain rows instead of ORM entities
+        query = select(*TRANSACTION_LISTING_COLUMNS)
+        result = await self.db.execute(apply_keyset(query, Transaction, limit, cursor, offset))
+        transactions = result.all()
+        pagination = await paginate(self.db, query, transactions, limit, with_total)
+        transactions = transactions[:limit]
+
+        if not expand_details:
+            return [TransactionSchema.model_validate(transaction) for transaction in transactions], pagination
+
+        # Details of the whole page in one batched IN query
+        details = {transaction.id: [] for transaction in transactions}
+        if details:
+            result = await self.db.execute(
+                select(*TRANSACTION_DETAIL_LISTING_COLUMNS)
+                .where(TransactionDetail.transaction_id.in_(details.keys()))
+                .order_by(TransactionDetail.created_at, TransactionDetail.id)
+            )
+            for detail in result.all():
+                details[detail.transaction_id].append(TransactionDetailSchema.model_validate(detail))
+
+        return [
+            TransactionWithDetailsSchema(**TransactionSchema.model_validate(transaction).model_dump(), transaction_details=details[transaction.id])
+            for transaction in transactions
+        ], pagination
 
     async def get_transaction_details(self, transaction_id: UUID4):
         result = await self.db.execute(select(TransactionDetail).where(TransactionDetail.transaction_id == transaction_id))
         transaction_details = result.scalars().all()
         return [TransactionDetailSchema.model_validate(detail) for detail in transaction_details]
 
-    async def create_anonymous_customer(self):
-        anonymous_customer = Customer(
-            name="Anonymous",
-            gender=GenderEnum.male,
-            age=0,
-            phone_number="0000000000",
-            email="anonymous@example.com",
-            address=None,
-            created_at=datetime.now(),
-            updated_at=datetime.now(),
+    async def get_anonymous_customer_id(self):
+        global anonymous_customer_id
+        if anonymous_customer_id is not None:
+            return anonymous_customer_id
+
+        # One shared sentinel customer for every walk-in sale, created on first use (a no-op if another worker won the race)
+        await self.db.execute(
+            insert(Customer)
+            .values(
+                id=ANONYMOUS_CUSTOMER_ID,
+                name="Anonymous",
+                gender=GenderEnum.male,
+                age=0,
+                phone_number="0000000000",
+                email=ANONYMOUS_CUSTOMER_EMAIL,
+                address=None,
+                created_at=datetime.now(),
+                updated_at=datetime.now(),
+            )
+            .on_conflict_do_nothing(index_elements=[Customer.email])
         )
-        self.db.add(anonymous_customer)
         await self.db.commit()
-        await self.db.refresh(anonymous_customer)
-        return anonymous_customer
+
+        # An anonymous customer created before the sentinel existed keeps its own id
+        result = await self.db.execute(select(Customer.id).where(Customer.email == ANONYMOUS_CUSTOMER_EMAIL))
+        anonymous_customer_id = result.scalar_one()
+        return anonymous_customer_id
 
     async def create_transaction(self, transaction_data: TransactionCreate):
         if not transaction_data.membership_id:
-            anonymous_customer = await self.create_anonymous_customer()
-            customer_id = anonymous_customer.id
+            customer_id = await self.get_anonymous_customer_id()
         else:
             membership = await self.db.execute(select(Membership).filter_by(id=transaction_data.membership_id))
             membership = membership.scalars().first()
@@ -486,35 +349,77 @@ class TransactionService:
                 return error_response(404, "Membership not found.")
             customer_id = membership.customer_id
 
+        # Quantities per product, a product on several lines is checked and decremented once
+        quantities = {}
+        for detail in transaction_data.transaction_details:
+            quantities[detail.product_id] = quantities.get(detail.product_id, 0) + detail.quantity
+
+        # Prices come from the catalog in a single IN query, prices sent by the client are not trusted
+        result = await self.db.execute(select(Product.id, Product.price).where(Product.id.in_(quantities.keys()), Product.deleted == False))
+        prices = dict(result.all())
+        missing_products = [str(product_id) for product_id in quantities if product_id not in prices]
+        if missing_products:
+            return error_response(404, f"Product not found: {', '.join(missing_products)}")
+
+        now = datetime.now()
         new_transaction = Transaction(
+            id=uuid.uuid4(),
             customer_id=customer_id,
             membership_id=transaction_data.membership_id,
             date=transaction_data.date,
-            total_amount=0,
-            created_at=datetime.now(),
-            updated_at=datetime.now(),
+            created_at=now,
+            updated_at=now,
         )
-        self.db.add(new_transaction)
-        await self.db.commit()
-        await self.db.refresh(new_transaction)
-
-        total_amount = 0
-        for detail in transaction_data.transaction_details:
-            total_amount += detail.quantity * detail.price_per_unit
-            new_detail = TransactionDetail(
+        new_details = [
+            TransactionDetail(
                 transaction_id=new_transaction.id,
                 product_id=detail.product_id,
                 quantity=detail.quantity,
-                price_per_unit=detail.price_per_unit,
-                total_amount=detail.quantity * detail.price_per_unit,
-                created_at=datetime.now(),
-                updated_at=datetime.now(),
+                price_per_unit=prices[detail.product_id],
+                total_amount=detail.quantity * prices[detail.product_id],
+                created_at=now,
+                updated_at=now,
             )
-            self.db.add(new_detail)
+            for detail in transaction_data.transaction_details
+        ]
+        new_transaction.total_amount = sum((detail.total_amount for detail in new_details), Decimal(0))
+        self.db.add(new_transaction)
+        self.db.add_all(new_details)
+        await self.db.flush()
 
-        new_transaction.total_amount = total_amount
+        # One guarded UPDATE ... FROM (VALUES ...) decrements every product, issued last so its row locks are held only until the commit
+        requested = values(column("id", UUID(as_uuid=True)), column("quantity", Integer), name="requested").data(sorted(quantities.items()))
+        result = await self.db.execute(
+            update(Product)
+            .where(Product.id == requested.c.id, Product.stock >= requested.c.quantity)
+            .values(stock=Product.stock - requested.c.quantity, updated_at=now)
+            .returning(Product.id)
+            .execution_options(synchronize_session=False)
+        )
+        decremented = set(result.scalars().all())
+        if len(decremented) != len(quantities):
+            await self.db.rollback()
+            out_of_stock = [str(product_id) for product_id in quantities if product_id not in decremented]
+            return error_response(409, f"Insufficient stock for product: {', '.join(out_of_stock)}")
         await self.db.commit()
-        await self.db.refresh(new_transaction)
+
+        # Stock is part of the cached product pages and their ETags, drop the sold products and every product listing
+        catalog_cache.clear(lambda key: key[0] == "products" or (key[0] == "product" and key[1] in quantities))
+
+        if config.online_scoring and config.ml_enabled and transaction_data.membership_id:
+            # The sale is already committed, a scoring failure only leaves the segment stale until the next batch run
+            try:
+                from app.segmentation import OnlineScoringService
+
+                await OnlineScoringService(self.db).score_customer(
+                    customer_id,
+                    transaction_data.date,
+                    [detail.quantity for detail in new_details],
+                    [detail.price_per_unit for detail in new_details],
+                )
+            except Exception as e:
+                await self.db.rollback()
+                print(f"Online scoring failed for customer {customer_id}: {e}")
 
         return TransactionSchema.model_validate(new_transaction)
 
@@ -532,10 +437,14 @@ class MembershipService:
     def __init__(self, db: AsyncSession):
         self.db = db
 
-    async def get_all_memberships(self, limit: int, offset: int):
-        result = await self.db.execute(select(Membership, Customer.name).join(Customer, Membership.customer_id == Customer.id).limit(limit).offset(offset))
+    async def get_all_memberships(self, limit: int, offset: int = 0, cursor: str = None, with_total: bool = False):
+        query = select(Membership, Customer.name).join(Customer, Membership.customer_id == Customer.id)
+        result = await self.db.execute(apply_keyset(query, Membership, limit, cursor, offset))
         memberships = result.all()
-        return [{**MembershipSchema.model_validate(membership).model_dump(), "name": customer_name} for membership, customer_name in memberships]
+        pagination = await paginate(self.db, select(Membership), memberships, limit, with_total, key=lambda row: row[0])
+        return [
+            {**MembershipSchema.model_validate(membership).model_dump(), "name": customer_name} for membership, customer_name in memberships[:limit]
+        ], pagination
 
     async def get_membership(self, membership_id: str):
         result = await self.db.execute(
@@ -586,5 +495,200 @@ class MembershipService:
 # endregion
 
 # region CUSTOMER
+class CustomerService:
+    def __init__(self, db: AsyncSession):
+        self.db = db
+
+    async def get_customer_segments(self, customer_ids: List[UUID4], algorithm: str = "kmeans"):
+        algorithm = AlgorithmEnum(algorithm)
+        customer_ids = list(dict.fromkeys(customer_ids))
+        segments = {}
+        missing_ids = []
+
+        for customer_id in customer_ids:
+            segment = segment_cache.get((algorithm, customer_id))
+            if segment is MISSING:
+                missing_ids.append(customer_id)
+            else:
+                segments[customer_id] = segment
+
+        if missing_ids:
+            # Plain column rows through the (algorithm, customer_id) index, no ORM entities needed
+            result = await self.db.execute(
+                select(
+                    SegmentationResult.customer_id,
+                    SegmentationResult.algorithm,
+                    SegmentationResult.rfm_category,
+                    SegmentationResult.cluster,
+                    SegmentationResult.recency,
+                    SegmentationResult.frequency,
+                    SegmentationResult.monetary,
+                    SegmentationResult.updated_at,
+                ).where(SegmentationResult.algorithm == algorithm, SegmentationResult.customer_id.in_(missing_ids))
+            )
+            found = {row.customer_id: CustomerSegmentSchema.model_validate(row) for row in result.all()}
+
+            # Unsegmented customers are cached as None too, so repeated lookups for them skip the database
+            for customer_id in missing_ids:
+                segments[customer_id] = found.get(customer_id)
+                segment_cache.set((algorithm, customer_id), segments[customer_id])
+
+        return [segments[customer_id] for customer_id in customer_ids if segments[customer_id] is not None]
+
+    async def get_customer_segment(self, customer_id: UUID4, algorithm: str = "kmeans"):
+        segments = await self.get_customer_segments([customer_id], algorithm)
+        return segments[0] if segments else None
+
+
+# endregion
+
+
+# region SEGMENTATION EXPORT
+EXPORT_BATCH_SIZE = 5000
+EXPORT_COLUMNS = ["customer_id", "algorithm", "rfm_category", "cluster", "recency", "frequency", "monetary", "updated_at"]
+EXPORT_FORMATS = {"ndjson": "application/x-ndjson", "csv": "text/csv", "parquet": "application/vnd.apache.parquet"}
+
+
+def export_record(row):
+    return (str(row.customer_id), row.algorithm.value, row.rfm_category, row.cluster, row.recency, row.frequency, float(row.monetary), row.updated_at)
+
+
+class NdjsonEncoder:
+    def begin(self):
+        return b""
+
+    def encode(self, records: list):
+        return b"".join(orjson.dumps(dict(zip(EXPORT_COLUMNS, record))) + b"\n" for record in records)
+
+    def end(self):
+        return b""
+
+
+class CsvEncoder:
+    def __init__(self):
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer)
+
+    def drain(self):
+        data = self.buffer.getvalue().encode()
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        return data
+
+    def begin(self):
+        self.writer.writerow(EXPORT_COLUMNS)
+        return self.drain()
+
+    def encode(self, records: list):
+        self.writer.writerows(record[:-1] + (record[-1].isoformat(),) for record in records)
+        return self.drain()
+
+    def end(self):
+        return b""
+
+
+class ParquetSink(io.RawIOBase):
+    # Write-only file handed to ParquetWriter, tell() keeps counting across drains so the footer offsets stay valid
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+class ParquetEncoder:
+    def __init__(self):
+        # pyarrow is only needed for this format, imported on first use
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        self.pa = pa
+        self.schema = pa.schema(
+            [
+                ("customer_id", pa.string()),
+                ("algorithm", pa.string()),
+                ("rfm_category", pa.string()),
+                ("cluster", pa.int32()),
+                ("recency", pa.int32()),
+                ("frequency", pa.int32()),
+                ("monetary", pa.float64()),
+                ("updated_at", pa.timestamp("us")),
+            ]
+        )
+        self.sink = ParquetSink()
+        self.writer = pq.ParquetWriter(self.sink, self.schema)
+
+    def begin(self):
+        return self.sink.drain()
+
+    def encode(self, records: list):
+        # Every fetched batch becomes one row group
+        self.writer.write_batch(self.pa.RecordBatch.from_arrays([self.pa.array(values) for values in zip(*records)], schema=self.schema))
+        return self.sink.drain()
+
+    def end(self):
+        self.writer.close()
+        return self.sink.drain()
+
+
+EXPORT_ENCODERS = {"ndjson": NdjsonEncoder, "csv": CsvEncoder, "parquet": ParquetEncoder}
+
+
+class SegmentationExportService:
+    def __init__(self, algorithm: str = "kmeans", format: str = "ndjson", compress: bool = False):
+        self.algorithm = AlgorithmEnum(algorithm)
+        self.format = format
+        self.compress = compress
+        # Built up front so a missing optional dependency fails before the response starts
+        self.encoder = EXPORT_ENCODERS[format]()
+
+    @property
+    def media_type(self):
+        return "application/gzip" if self.compress else EXPORT_FORMATS[self.format]
+
+    @property
+    def filename(self):
+        return f"segmentation-{self.algorithm.value}.{self.format}" + (".gz" if self.compress else "")
+
+    async def encoded_chunks(self):
+        # The response body outlives the request's session, so the export opens its own
+        # Long-running read, served by the replica when it is caught up
+        async with (await read_session_factory())() as db:
+            # Server-side cursor over the (algorithm, customer_id) index, only one batch is held in memory at a time
+            result = await db.stream(
+                select(*[getattr(SegmentationResult, column) for column in EXPORT_COLUMNS])
+                .where(SegmentationResult.algorithm == self.algorithm)
+                .order_by(SegmentationResult.customer_id)
+                .execution_options(yield_per=EXPORT_BATCH_SIZE)
+            )
+            yield self.encoder.begin()
+            async for rows in result.partitions():
+                yield self.encoder.encode([export_record(row) for row in rows])
+        yield self.encoder.end()
+
+    async def stream(self):
+        compressor = zlib.compressobj(wbits=31) if self.compress else None
+        async for chunk in self.encoded_chunks():
+            if compressor:
+                chunk = compressor.compress(chunk)
+            if chunk:
+                yield chunk
+        if compressor:
+            yield compressor.flush()
+
 
 # endregion
@@ -0,0 +1,169 @@
+from itertools import chain, zip_longest
+from joblib import Parallel, delayed, dump
+from sklearn.preprocessing import StandardScaler
+from sklearn.metrics import silhouette_score, davies_bouldin_score
+from sklearn.cluster import KMeans, DBSCAN
+from datetime import datetime
+from app.config import config
+from app.db import SessionLocal
+from app.models import AlgorithmEnum
+from app.segmentation import SegmentationService
+from app.services import RFM_FEATURES, MODEL_PARAMS_FILE
+import argparse
+import asyncio
+import json
+import os
+import re
+import time
+
+KMEANS_CLUSTER_RANGE = range(2, 11)
+DBSCAN_EPS_GRID = [0.1, 0.2, 0.3, 0.5, 0.75, 1.0, 1.5]
+DBSCAN_MIN_SAMPLES_GRID = [3, 5, 10, 20]
+
+
+def build_model(algorithm: str, params: dict, random_state: int):
+    if algorithm == AlgorithmEnum.kmeans.value:
+        return KMeans(**params, random_state=random_state)
+    return DBSCAN(**params)
+
+
+def build_candidates():
+    kmeans_candidates = [(AlgorithmEnum.kmeans.value, {"n_clusters": k}) for k in KMEANS_CLUSTER_RANGE]
+    dbscan_candidates = [
+        (AlgorithmEnum.dbscan.value, {"eps": eps, "min_samples": min_samples}) for eps in DBSCAN_EPS_GRID for min_samples in DBSCAN_MIN_SAMPLES_GRID
+    ]
+
+    # Interleave both grids so each algorithm gets candidates scored even when the time budget runs out early
+    return [candidate for candidate in chain.from_iterable(zip_longest(kmeans_candidates, dbscan_candidates)) if candidate]
+
+
+def score_candidate(algorithm, params, features, deadline, score_sample_size, max_noise_ratio, random_state):
+    # Candidates still queued once the time budget is spent are skipped
+    if time.time() > deadline:
+        return None
+
+    started = time.time()
+    labels = build_model(algorithm, params, random_state).fit_predict(features)
+
+    # Noise points (-1) are left out of scoring, too much noise disqualifies a candidate
+    mask = labels != -1
+    noise_ratio = 1 - mask.mean()
+    n_clusters = len(set(labels[mask]))
+    if noise_ratio > max_noise_ratio or n_clusters < 2 or n_clusters >= mask.sum():
+        return None
+
+    try:
+        silhouette = silhouette_score(features[mask], labels[mask], sample_size=min(score_sample_size, mask.sum()), random_state=random_state)
+        db_index = davies_bouldin_score(features[mask], labels[mask])
+    except ValueError:
+        # The silhouette sample can end up with a single cluster
+        return None
+
+    return {
+        "algorithm": algorithm,
+        "params": params,
+        "n_clusters": n_clusters,
+        "noise_ratio": float(noise_ratio),
+        "silhouette_score": float(silhouette),
+        "davies_bouldin_index": float(db_index),
+        "duration": time.time() - started,
+    }
+
+
+def sweep(df_rfm, time_budget: float, sample_size: int, score_sample_size: int, max_noise_ratio: float, n_jobs: int, random_state: int):
+    deadline = time.time() + time_budget
+    df_sample = df_rfm.sample(n=min(sample_size, len(df_rfm)), random_state=random_state)
+    raw_features = df_sample[RFM_FEATURES].astype(float).to_numpy()
+
+    # Same feature spaces as the online pipeline: KMeans on raw RFM, DBSCAN on standardized RFM
+    scaler = StandardScaler().fit(raw_features)
+    features = {
+        AlgorithmEnum.kmeans.value: raw_features,
+        AlgorithmEnum.dbscan.value: scaler.transform(raw_features),
+    }
+
+    scored = []
+    parallel = Parallel(n_jobs=n_jobs, return_as="generator_unordered")
+    tasks = (
+        delayed(score_candidate)(algorithm, params, features[algorithm], deadline, score_sample_size, max_noise_ratio, random_state)
+        for algorithm, params in build_candidates()
+    )
+    for candidate in parallel(tasks):
+        if candidate:
+            print(f"{candidate['algorithm']} {candidate['params']}: silhouette={candidate['silhouette_score']:.4f}, db={candidate['davies_bouldin_index']:.4f}")
+            scored.append(candidate)
+        if time.time() > deadline:
+            print("Time budget exhausted, stopping the sweep.")
+            break
+
+    # Best silhouette wins, Davies-Bouldin breaks ties
+    winners = {}
+    for candidate in sorted(scored, key=lambda c: (-c["silhouette_score"], c["davies_bouldin_index"])):
+        winners.setdefault(candidate["algorithm"], candidate)
+
+    return winners, scaler, features
+
+
+def next_model_version(model_directory: str):
+    versions = [int(match.group(1)) for name in os.listdir(model_directory) if (match := re.fullmatch(r"v(\d+)", name))]
+    return f"v{max(versions, default=0) + 1}"
+
+
+def save_models(winners: dict, scaler: StandardScaler, features: dict, sample_size: int, random_state: int):
+    version = next_model_version(config.model_directory)
+    model_path = os.path.join(config.model_directory, version)
+    os.makedirs(model_path)
+
+    # Refit the winners here rather than shipping fitted models back from the workers, stored with joblib like models/v1
+    for algorithm, winner in winners.items():
+        model = build_model(algorithm, winner["params"], random_state).fit(features[algorithm])
+        dump(model, os.path.join(model_path, f"{algorithm}_model.pkl"))
+
+    dump(scaler, os.path.join(model_path, "scaler.pkl"))
+
+    params = {algorithm: winner["params"] for algorithm, winner in winners.items()}
+    params["tuning"] = {"tuned_at": datetime.now().isoformat(), "sample_size": sample_size, "winners": winners}
+    with open(os.path.join(model_path, MODEL_PARAMS_FILE), "w") as f:
+        json.dump(params, f, indent=2)
+
+    return version
+
+
+async def load_rfm(start_date: datetime = None, end_date: datetime = None):
+    async with SessionLocal() as session:
+        segmentation_service = SegmentationService(session)
+        await segmentation_service.compute_rfm(start_date=start_date, end_date=end_date)
+        return segmentation_service.df_rfm
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sweep KMeans/DBSCAN hyperparameters and write the winners into a new model version.")
+    parser.add_argument("--time-budget", type=float, default=3600, help="Seconds the sweep may run before remaining candidates are skipped")
+    parser.add_argument("--sample-size", type=int, default=50000, help="Number of customers sampled from the RFM matrix")
+    parser.add_argument("--score-sample-size", type=int, default=10000, help="Number of points used for the sampled silhouette score")
+    parser.add_argument("--max-noise-ratio", type=float, default=0.2, help="Maximum share of DBSCAN noise points for a candidate to qualify")
+    parser.add_argument("--n-jobs", type=int, default=-1, help="joblib workers, -1 uses all cores")
+    parser.add_argument("--start-date", help="Start date in YYYY-MM-DD format")
+    parser.add_argument("--end-date", help="End date in YYYY-MM-DD format")
+    parser.add_argument("--random-state", type=int, default=42)
+    args = parser.parse_args()
+
+    start_date = datetime.strptime(args.start_date, "%Y-%m-%d") if args.start_date else None
+    end_date = datetime.strptime(args.end_date, "%Y-%m-%d") if args.end_date else None
+
+    started = time.time()
+    df_rfm = asyncio.run(load_rfm(start_date, end_date))
+    remaining_budget = max(args.time_budget - (time.time() - started), 0)
+
+    winners, scaler, features = sweep(df_rfm, remaining_budget, args.sample_size, args.score_sample_size, args.max_noise_ratio, args.n_jobs, args.random_state)
+    if not winners:
+        raise SystemExit("No candidate could be scored within the time budget.")
+
+    version = save_models(winners, scaler, features, args.sample_size, args.random_state)
+    print(f"Saved tuned models to {config.model_directory}/{version}. Set MODEL_VERSION={version} to activate them.")
+
+
+if __name__ == "__main__":
+    main()
+
+# ? Run with: `python -m app.tuning --time-budget 3600`
@@ -1,25 +1,102 @@
-from fastapi import HTTPException
+from fastapi import HTTPException, Request
 from fastapi.encoders import jsonable_encoder
-from fastapi.responses import JSONResponse
+from fastapi.responses import Response
 from pydantic import BaseModel
+from pydantic_core import to_json
+from sqlalchemy import text, tuple_
+from sqlalchemy.dialects import postgresql
+from datetime import datetime
+from decimal import Decimal
 from typing import Any
-import random, string
+import base64
+import hashlib
+import orjson
+import json
 
+ORJSON_OPTIONS = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
 
-def success_response(status_code: int, message: str, data: Any):
-    if isinstance(data, BaseModel):
-        data = data.model_dump()
-    elif isinstance(data, list) and all(isinstance(item, BaseModel) for item in data):
-        data = [item.model_dump() for item in data]
-    encoded_data = jsonable_encoder({"message": message, "data": data})
-    return JSONResponse(status_code=status_code, content=encoded_data)
+
+def json_default(obj: Any):
+    # Types orjson does not handle natively, encoded the same way FastAPI's jsonable_encoder does
+    if isinstance(obj, BaseModel):
+        return obj.model_dump(mode="json")
+    if isinstance(obj, Decimal):
+        return int(obj) if obj.as_tuple().exponent >= 0 else float(obj)
+    # Anything else (e.g. ORM objects) keeps the previous encoding
+    return jsonable_encoder(obj)
+
+
+def dump_json(data: Any) -> bytes:
+    # Pydantic models (and lists of them) go straight through their Rust serializer, everything else through orjson
+    if isinstance(data, BaseModel) or (isinstance(data, list) and all(isinstance(item, BaseModel) for item in data)):
+        return to_json(data)
+    return orjson.dumps(data, default=json_default, option=ORJSON_OPTIONS)
+
+
+def success_response(status_code: int, message: str, data: Any, pagination: dict = None, headers: dict = None):
+    # The envelope is assembled from pre-encoded parts so the payload is walked exactly once
+    content = b'{"message":' + orjson.dumps(message) + b',"data":' + dump_json(data)
+    if pagination is not None:
+        content += b',"pagination":' + dump_json(pagination)
+    return Response(status_code=status_code, content=content + b"}", media_type="application/json", headers=headers)
+
+
+def compute_etag(*parts: Any):
+    return '"' + hashlib.blake2b(dump_json(list(parts)), digest_size=16).hexdigest() + '"'
+
+
+def etag_matches(request: Request, etag: str):
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    candidates = [candidate.strip().removeprefix("W/") for candidate in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates
+
+
+def not_modified_response(etag: str):
+    return Response(status_code=304, headers={"ETag": etag})
 
 
 def error_response(status_code, message):
     raise HTTPException(status_code=status_code, detail=message)
 
 
-def generate_membership_id():
-    prefix = "GSR"
-    suffix = "".join(random.choices(string.ascii_uppercase + string.digits, k=5))
-    return f"{prefix}-{suffix}"
+def encode_cursor(created_at: datetime, id: Any):
+    payload = json.dumps([created_at.isoformat(), str(id)]).encode()
+    return base64.urlsafe_b64encode(payload).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str):
+    try:
+        payload = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        created_at, id = json.loads(payload)
+        return datetime.fromisoformat(created_at), id
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+
+def apply_keyset(query, model, limit: int, cursor: str = None, offset: int = 0):
+    # Stable (created_at, id) order, a cursor seeks past the last row instead of scanning the skipped ones
+    query = query.order_by(model.created_at, model.id).limit(limit + 1)
+    if cursor:
+        created_at, id = decode_cursor(cursor)
+        return query.where(tuple_(model.created_at, model.id) > (created_at, model.id.type.python_type(id)))
+    return query.offset(offset)
+
+
+def next_page_cursor(rows: list, limit: int, key=lambda row: row):
+    # One extra row is fetched to know whether another page exists
+    if len(rows) <= limit:
+        return None
+    last = key(rows[limit - 1])
+    return encode_cursor(last.created_at, last.id)
+
+
+async def estimate_count(db, query):
+    # Row estimate from the planner statistics instead of a full COUNT(*)
+    compiled = query.compile(dialect=postgresql.dialect(), compile_kwargs={"literal_binds": True})
+    result = await db.execute(text(f"EXPLAIN (FORMAT JSON) {compiled}"))
+    plan = result.scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]["Plan"]["Plan Rows"])
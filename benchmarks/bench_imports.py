@@ -0,0 +1,78 @@
+from collections import defaultdict
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+# Packages a worker that only serves the API should never load at startup
+ML_PACKAGES = ["pandas", "numpy", "sklearn", "scipy", "joblib", "pyarrow", "faker"]
+
+# Runs in a fresh interpreter so every measurement is a cold import
+CHILD = """
+import json, psutil, sys, time
+started = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - started
+loaded = sorted({{name.split(".")[0] for name in sys.modules}} & set({packages!r}))
+print(json.dumps({{"seconds": seconds, "rss_mb": psutil.Process().memory_info().rss / 2**20, "ml_packages": loaded}}))
+"""
+
+
+def package_times(importtime: str):
+    # -X importtime lines are "import time: self | cumulative | name", self times summed per top-level package
+    totals = defaultdict(int)
+    for line in importtime.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        self_time, _, name = line[len("import time:") :].split("|")
+        totals[name.strip().split(".")[0]] += int(self_time)
+    return {package: microseconds / 1e6 for package, microseconds in totals.items()}
+
+
+def measure(module: str):
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", CHILD.format(module=module, packages=ML_PACKAGES)], capture_output=True, text=True
+    )
+    if process.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{process.stderr[-2000:]}")
+    return json.loads(process.stdout.strip().splitlines()[-1]), package_times(process.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cold import time and RSS of the API and of the segmentation engine, from python -X importtime.")
+    parser.add_argument("--modules", nargs="+", default=["app.main", "app.segmentation"])
+    parser.add_argument("--repeat", type=int, default=5, help="Fresh interpreters per module, the median is reported")
+    parser.add_argument("--top", type=int, default=10, help="Slowest top-level packages to list")
+    parser.add_argument("--output", help="Also write the report as JSON")
+    args = parser.parse_args()
+
+    report = {}
+    for module in args.modules:
+        runs = [measure(module) for _ in range(args.repeat)]
+        packages = {package: statistics.median(run[1].get(package, 0) for run in runs) for package in runs[0][1]}
+        report[module] = {
+            "seconds": statistics.median(run[0]["seconds"] for run in runs),
+            "rss_mb": statistics.median(run[0]["rss_mb"] for run in runs),
+            "ml_packages": runs[0][0]["ml_packages"],
+            "packages": dict(sorted(packages.items(), key=lambda item: item[1], reverse=True)[: args.top]),
+        }
+
+        print(f"{module}: {report[module]['seconds']:.3f}s  {report[module]['rss_mb']:.1f} MB RSS  ML packages: {', '.join(report[module]['ml_packages']) or 'none'}")
+        for package, seconds in report[module]["packages"].items():
+            print(f"  {package:<32} {seconds:8.3f}s")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    # The API entry point importing the ML stack again is a regression
+    if report.get("app.main", {}).get("ml_packages"):
+        print(f"app.main imports {', '.join(report['app.main']['ml_packages'])} at startup")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
+
+# ? Run with: `python -m benchmarks.bench_imports --repeat 5`
@@ -0,0 +1,58 @@
+from app.services import AuthService, pwd_context
+import argparse
+import asyncio
+import time
+
+
+async def legacy_login(password: str, hashed_password: str):
+    # Previous behaviour: bcrypt verify straight inside the async handler
+    return pwd_context.verify(password, hashed_password)
+
+
+async def offloaded_login(password: str, hashed_password: str):
+    return await AuthService(None).verify_password(password, hashed_password)
+
+
+async def ticker(stop: asyncio.Event, lags: list, interval: float = 0.01):
+    # Measures how late the event loop wakes up while logins are in flight
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - started - interval)
+
+
+async def run(login, logins: int, concurrency: int, password: str, hashed_password: str):
+    semaphore = asyncio.Semaphore(concurrency)
+    stop = asyncio.Event()
+    lags = []
+
+    async def one():
+        async with semaphore:
+            assert await login(password, hashed_password)
+
+    ticker_task = asyncio.create_task(ticker(stop, lags))
+    started = time.perf_counter()
+    await asyncio.gather(*(one() for _ in range(logins)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await ticker_task
+    return logins / elapsed, max(lags, default=0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Login throughput with bcrypt on the event loop versus the password hash pool.")
+    parser.add_argument("--logins", type=int, default=64)
+    parser.add_argument("--concurrency", type=int, default=32)
+    args = parser.parse_args()
+
+    password = "benchmark-password"
+    hashed_password = pwd_context.hash(password)
+    for name, login in [("event loop", legacy_login), ("thread pool", offloaded_login)]:
+        throughput, max_lag = asyncio.run(run(login, args.logins, args.concurrency, password, hashed_password))
+        print(f"{name:<12} {throughput:8.1f} logins/s   max event loop lag {max_lag * 1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
+
+# ? Run with: `python -m benchmarks.bench_login`
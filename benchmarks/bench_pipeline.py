@@ -0,0 +1,163 @@
+from sqlalchemy import event
+from datetime import datetime
+from app.config import config
+from app.db import SessionLocal, async_engine
+from app.models import AlgorithmEnum
+from app.seed import PRESETS, parse_args, seed
+from app.segmentation import CLUSTERING_FUNCTIONS, SegmentationService
+from app.services import MODEL_PARAMS_FILE, shared_cache
+import argparse
+import asyncio
+import json
+import os
+import platform
+import psutil
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+RSS_SAMPLE_INTERVAL = 0.01
+
+
+class StageRecorder:
+    # Wall time, peak RSS and executed statements of each pipeline stage
+    def __init__(self):
+        self.process = psutil.Process()
+        self.queries = 0
+        self.stages = []
+        event.listen(async_engine.sync_engine, "before_cursor_execute", self.count_query)
+
+    def count_query(self, *args):
+        self.queries += 1
+
+    async def measure(self, name: str, stage):
+        peak_rss = self.process.memory_info().rss
+        rss_before = peak_rss
+        queries_before = self.queries
+        stop = threading.Event()
+
+        # RSS is sampled from a thread so stages running pandas/sklearn off the event loop are covered too
+        def sample():
+            nonlocal peak_rss
+            while not stop.wait(RSS_SAMPLE_INTERVAL):
+                peak_rss = max(peak_rss, self.process.memory_info().rss)
+
+        sampler = threading.Thread(target=sample, daemon=True)
+        sampler.start()
+        started = time.perf_counter()
+        try:
+            await stage()
+        finally:
+            elapsed = time.perf_counter() - started
+            stop.set()
+            sampler.join()
+
+        rss_after = self.process.memory_info().rss
+        record = {
+            "stage": name,
+            "seconds": elapsed,
+            "peak_rss_mb": max(peak_rss, rss_after) / 2**20,
+            "rss_delta_mb": (rss_after - rss_before) / 2**20,
+            "queries": self.queries - queries_before,
+        }
+        self.stages.append(record)
+        print(f"  {name:<36} {elapsed:9.3f}s {record['peak_rss_mb']:9.1f} MB peak {record['queries']:7d} queries")
+        return record
+
+
+async def run_pipeline(recorder: StageRecorder, num_batches: int):
+    # A cold run: no stored results and no cached RFM features
+    await shared_cache.clear()
+
+    async with SessionLocal() as session:
+        service = SegmentationService(session)
+        await recorder.measure("preprocess", lambda: service.preprocess(num_batches=num_batches))
+        if service.df_rfm is None:
+            # preprocess served stored results, the fitting stages still need the RFM matrix
+            await recorder.measure("compute_rfm", lambda: service.compute_rfm(num_batches=num_batches, use_cache=False))
+        df_rfm = service.df_rfm
+
+        for algorithm in AlgorithmEnum:
+            # with_<algorithm> split in two, so the fit and the save are timed apart and the results are saved once
+            async def fit(algorithm=algorithm):
+                # Each algorithm starts from the same RFM matrix, as it would in its own request
+                service.df_rfm = CLUSTERING_FUNCTIONS[algorithm.value](df_rfm)
+                service.segmented_data = service.df_rfm.copy()
+                service.algorithm = algorithm
+
+            await recorder.measure(f"cluster_{algorithm.value}", fit)
+            await recorder.measure(f"save_segmentation_results[{algorithm.value}]", service.save_segmentation_results)
+            await recorder.measure(f"result[{algorithm.value}]", service.result)
+
+    await shared_cache.clear()
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(presets: list, seed_value: int, end_date: str, num_batches: int, reuse: bool):
+    datasets = []
+    for preset in presets:
+        print(f"{preset}:")
+        counts = None
+        seed_seconds = None
+        if not reuse:
+            started = time.perf_counter()
+            counts = await seed(parse_args(["--preset", preset, "--seed", str(seed_value), "--end-date", end_date, "--truncate"]))
+            seed_seconds = time.perf_counter() - started
+            print(f"  {'seed':<36} {seed_seconds:9.3f}s")
+
+        recorder = StageRecorder()
+        await run_pipeline(recorder, num_batches)
+        event.remove(async_engine.sync_engine, "before_cursor_execute", recorder.count_query)
+        datasets.append({"preset": preset, "size": PRESETS.get(preset), "rows": counts, "seed_seconds": seed_seconds, "stages": recorder.stages})
+
+    return datasets
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time every stage of the segmentation pipeline on seeded datasets of increasing size.")
+    parser.add_argument("--presets", nargs="+", choices=PRESETS, default=["small", "medium"], help="Datasets from app.seed, run in the given order")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--end-date", default="2025-01-01", help="Pinned so every run benchmarks the same rows")
+    parser.add_argument("--num-batches", type=int, default=20, help="Batches compute_rfm reads the transactions in")
+    parser.add_argument("--reuse", action="store_true", help="Benchmark the data already in the database instead of seeding, --presets is then ignored")
+    parser.add_argument("--output", default="pipeline-benchmark.json", help="Where the JSON report is written")
+    args = parser.parse_args()
+
+    # SQL echo would mostly measure log formatting
+    async_engine.sync_engine.echo = False
+    if not args.reuse:
+        print("Seeding truncates the customer, product, membership, transaction and segmentation tables, use a scratch database.")
+
+    # cluster_kmeans/cluster_dbscan save the models they fit into the active model version, where online scoring picks them up.
+    # The benchmark works on a throwaway copy of the version that only keeps its tuned hyperparameters.
+    with tempfile.TemporaryDirectory() as model_path:
+        params_path = os.path.join(config.MODEL_PATH, MODEL_PARAMS_FILE)
+        if os.path.exists(params_path):
+            shutil.copy(params_path, model_path)
+        config.MODEL_PATH = model_path
+        datasets = asyncio.run(run(args.presets if not args.reuse else ["current"], args.seed, args.end_date, args.num_batches, args.reuse))
+    report = {
+        "created_at": datetime.now().isoformat(),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "cpu_count": os.cpu_count(),
+        "seed": args.seed,
+        "datasets": datasets,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Report written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
+
+# ? Run with: `python -m benchmarks.bench_pipeline --presets small medium`
@@ -0,0 +1,88 @@
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+from datetime import datetime, timedelta
+from app.schemas import ProductSchema, TransactionSchema
+from app.utils import success_response
+import argparse
+import random
+import timeit
+import uuid
+
+
+def legacy_success_response(status_code: int, message: str, data):
+    # success_response before the single-pass encoder: model_dump, jsonable_encoder, then json.dumps
+    if isinstance(data, BaseModel):
+        data = data.model_dump()
+    elif isinstance(data, list) and all(isinstance(item, BaseModel) for item in data):
+        data = [item.model_dump() for item in data]
+    encoded_data = jsonable_encoder({"message": message, "data": data})
+    return JSONResponse(status_code=status_code, content=encoded_data)
+
+
+def build_products(size: int):
+    now = datetime.now()
+    return [
+        ProductSchema(
+            id=uuid.uuid4(),
+            category_id=uuid.uuid4(),
+            name=f"Product {i}",
+            description="Synthetic product",
+            stock=random.randint(0, 500),
+            price=round(random.uniform(1, 100), 2),
+            deleted=False,
+            created_at=now - timedelta(minutes=i),
+            updated_at=now,
+        )
+        for i in range(size)
+    ]
+
+
+def build_transactions(size: int):
+    now = datetime.now()
+    return [
+        TransactionSchema(
+            id=uuid.uuid4(),
+            customer_id=uuid.uuid4(),
+            membership_id=None if i % 3 else "GSR-ABCDE",
+            date=now - timedelta(hours=i),
+            total_amount=round(random.uniform(1, 500), 2),
+            created_at=now,
+            updated_at=now,
+        )
+        for i in range(size)
+    ]
+
+
+def build_segmentation(size: int):
+    # Dict payloads (segmentation, memberships) take the orjson path
+    return {
+        "algorithm": "kmeans",
+        "segmentation": [{"rfm_category": f"Category {i}", "count": i, "total_revenue": i * 1.5} for i in range(size)],
+        "evaluation": {"silhouette_score": 0.42, "davies_bouldin_index": 0.87},
+    }
+
+
+def bench(name: str, data, repeat: int):
+    legacy = min(timeit.repeat(lambda: legacy_success_response(200, "ok", data), number=1, repeat=repeat))
+    fast = min(timeit.repeat(lambda: success_response(200, "ok", data), number=1, repeat=repeat))
+    print(f"{name:<28} legacy {legacy * 1000:9.2f} ms   fast {fast * 1000:9.2f} ms   speedup {legacy / fast:5.1f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare success_response against the previous triple-pass encoder.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    random.seed(42)
+    for size in args.sizes:
+        bench(f"products x{size}", build_products(size), args.repeat)
+        bench(f"transactions x{size}", build_transactions(size), args.repeat)
+        bench(f"segmentation x{size}", build_segmentation(size), args.repeat)
+
+
+if __name__ == "__main__":
+    main()
+
+# ? Run with: `python -m benchmarks.bench_responses`
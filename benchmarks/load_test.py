@@ -0,0 +1,326 @@
+from dataclasses import dataclass, field
+from datetime import datetime
+from app.routes import router
+import argparse
+import asyncio
+import httpx
+import json
+import random
+import subprocess
+import sys
+import time
+
+# Endpoint -> budget, "*" applies to every endpoint without its own entry. Latencies in milliseconds.
+DEFAULT_BUDGETS = {
+    "*": {"p95_ms": 500, "p99_ms": 1000, "error_rate": 0.01},
+    "POST /transactions/": {"p95_ms": 250, "p99_ms": 500, "error_rate": 0.01},
+    "GET /products/": {"p95_ms": 100, "p99_ms": 250, "error_rate": 0.0},
+    "GET /products/{product_id}": {"p95_ms": 50, "p99_ms": 100, "error_rate": 0.0},
+    "GET /dashboard/segmentation": {"p95_ms": 2000, "p99_ms": 5000, "error_rate": 0.0},
+    "POST /login": {"p95_ms": 500, "p99_ms": 1000, "error_rate": 0.0},
+}
+
+# Action weights of each traffic mix
+SCENARIOS = {
+    "pos": {"sale": 8, "product": 2},
+    "catalog": {"catalog_page": 4, "categories": 1, "product": 5},
+    "dashboard": {"metrics": 3, "segmentation": 3, "scheduler": 1, "customer_segment": 3},
+    "login": {"login": 1},
+    "backoffice": {"transactions_page": 4, "transaction_details": 3, "memberships_page": 2, "customer_segments": 2, "new_membership": 1, "product_admin": 1, "export": 1},
+    "mixed": {
+        "sale": 40,
+        "product": 20,
+        "catalog_page": 15,
+        "categories": 5,
+        "metrics": 4,
+        "segmentation": 2,
+        "customer_segment": 4,
+        "login": 10,
+        "transactions_page": 2,
+        "transaction_details": 2,
+        "memberships_page": 1,
+        "customer_segments": 1,
+    },
+}
+
+LOAD_TEST_USERNAME = "load-test"
+LOAD_TEST_PASSWORD = "load-test-password"
+
+
+def route_endpoints():
+    return {f"{method} {route.path}" for route in router.routes for method in route.methods}
+
+
+def percentile(sorted_values: list, q: float):
+    # Nearest-rank percentile
+    if not sorted_values:
+        return None
+    return sorted_values[min(int(q / 100 * len(sorted_values)), len(sorted_values) - 1)]
+
+
+@dataclass
+class EndpointStats:
+    latencies: list = field(default_factory=list)
+    statuses: dict = field(default_factory=dict)
+    errors: int = 0
+
+    def record(self, latency: float, status):
+        self.latencies.append(latency)
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        # Connection failures, server errors and rejected payloads count against the budget, other 4xx are expected (409 out of stock, 304)
+        if not isinstance(status, int) or status >= 500 or status == 422:
+            self.errors += 1
+
+    def summary(self, elapsed: float):
+        latencies = sorted(self.latencies)
+        return {
+            "requests": len(latencies),
+            "throughput_rps": len(latencies) / elapsed,
+            "p50_ms": percentile(latencies, 50) * 1000,
+            "p95_ms": percentile(latencies, 95) * 1000,
+            "p99_ms": percentile(latencies, 99) * 1000,
+            "max_ms": latencies[-1] * 1000,
+            "error_rate": self.errors / len(latencies),
+            "statuses": {str(status): count for status, count in sorted(self.statuses.items(), key=str)},
+        }
+
+
+class LoadTest:
+    def __init__(self, client: httpx.AsyncClient, scenario: str, seed: int):
+        self.client = client
+        self.weights = SCENARIOS[scenario]
+        self.random = random.Random(seed)
+        self.endpoints = route_endpoints()
+        self.stats = {}
+        self.product_ids = []
+        self.product_etags = {}
+        self.membership_ids = []
+        self.customer_ids = []
+        self.category_ids = []
+        self.transaction_ids = []
+
+    async def request(self, method: str, endpoint: str, url: str, **kwargs):
+        # Results are keyed by the router's own path templates, a renamed route fails loudly instead of reporting stale names
+        if f"{method} {endpoint}" not in self.endpoints:
+            raise ValueError(f"{method} {endpoint} is not a route of app.routes")
+        started = time.perf_counter()
+        try:
+            response = await self.client.request(method, url, **kwargs)
+            status = response.status_code
+        except httpx.HTTPError as e:
+            response, status = None, type(e).__name__
+        self.stats.setdefault(f"{method} {endpoint}", EndpointStats()).record(time.perf_counter() - started, status)
+        return response
+
+    async def prepare(self):
+        # IDs the actions pick from, read through the API like any client would
+        products = (await self.client.get("/products/", params={"limit": 500})).json()["data"]
+        memberships = (await self.client.get("/memberships/", params={"limit": 500})).json()["data"]
+        self.product_ids = [product["id"] for product in products if not product["deleted"]]
+        self.membership_ids = [membership["id"] for membership in memberships]
+        self.customer_ids = [membership["customer_id"] for membership in memberships]
+        self.category_ids = list({product["category_id"] for product in products})
+        if not self.product_ids:
+            raise SystemExit("No products found, seed the database first: python -m app.seed --preset small")
+        await self.client.post("/register", json={"username": LOAD_TEST_USERNAME, "password": LOAD_TEST_PASSWORD})
+
+    async def sale(self):
+        lines = [
+            {"product_id": product_id, "quantity": self.random.randint(1, 3)}
+            for product_id in self.random.sample(self.product_ids, min(self.random.randint(1, 5), len(self.product_ids)))
+        ]
+        # Roughly one sale in five is a walk-in without a membership
+        membership_id = self.random.choice(self.membership_ids) if self.membership_ids and self.random.random() > 0.2 else None
+        payload = {"membership_id": membership_id, "date": datetime.now().isoformat(), "transaction_details": lines}
+        await self.request("POST", "/transactions/", "/transactions/", json=payload)
+
+    async def product(self):
+        # Polling clients revalidate with the ETag they already hold
+        product_id = self.random.choice(self.product_ids)
+        headers = {"If-None-Match": self.product_etags[product_id]} if product_id in self.product_etags else {}
+        response = await self.request("GET", "/products/{product_id}", f"/products/{product_id}", headers=headers)
+        if response is not None and "etag" in response.headers:
+            self.product_etags[product_id] = response.headers["etag"]
+
+    async def catalog_page(self):
+        response = await self.request("GET", "/products/", "/products/", params={"limit": 20})
+        cursor = response.json()["pagination"]["next_cursor"] if response is not None and response.status_code == 200 else None
+        if cursor:
+            await self.request("GET", "/products/", "/products/", params={"limit": 20, "cursor": cursor})
+
+    async def categories(self):
+        await self.request("GET", "/product-categories/", "/product-categories/", params={"limit": 50})
+
+    async def metrics(self):
+        await self.request("GET", "/dashboard/metrics", "/dashboard/metrics")
+
+    async def segmentation(self):
+        await self.request("GET", "/dashboard/segmentation", "/dashboard/segmentation", params={"model": self.random.choice(["kmeans", "dbscan"])})
+
+    async def scheduler(self):
+        await self.request("GET", "/segmentation/scheduler", "/segmentation/scheduler")
+
+    async def customer_segment(self):
+        if self.customer_ids:
+            customer_id = self.random.choice(self.customer_ids)
+            await self.request("GET", "/customers/{customer_id}/segment", f"/customers/{customer_id}/segment")
+
+    async def transactions_page(self):
+        response = await self.request("GET", "/transactions/", "/transactions/", params={"limit": 20, "expand": "details"})
+        if response is not None and response.status_code == 200:
+            self.transaction_ids = [transaction["id"] for transaction in response.json()["data"]] or self.transaction_ids
+
+    async def transaction_details(self):
+        if self.transaction_ids:
+            transaction_id = self.random.choice(self.transaction_ids)
+            await self.request("GET", "/transactions/{transaction_id}", f"/transactions/{transaction_id}")
+
+    async def memberships_page(self):
+        await self.request("GET", "/memberships/", "/memberships/", params={"limit": 20})
+
+    async def customer_segments(self):
+        customer_ids = self.random.sample(self.customer_ids, min(50, len(self.customer_ids)))
+        await self.request("POST", "/customers/segments", "/customers/segments", json={"customer_ids": customer_ids, "algorithm": "kmeans"})
+
+    async def new_membership(self):
+        if self.customer_ids:
+            payload = {"customer_id": self.random.choice(self.customer_ids), "start_period": "2025-01-01", "end_period": "2025-12-31", "tier": "bronze"}
+            await self.request("POST", "/memberships/", "/memberships/", json=payload)
+
+    async def product_admin(self):
+        # Create, edit and remove a throwaway product, each write also invalidates the catalog cache
+        category_id = self.random.choice(self.category_ids)
+        payload = {"category_id": category_id, "name": "Load test product", "description": None, "stock": 10, "price": 9.99}
+        response = await self.request("POST", "/products/", "/products/", json=payload)
+        if response is None or response.status_code != 201:
+            return
+        product_id = response.json()["data"]["id"]
+        await self.request("PUT", "/products/{product_id}", f"/products/{product_id}", json={**payload, "stock": 5, "updated_at": datetime.now().isoformat()})
+        await self.request("DELETE", "/products/{product_id}", f"/products/{product_id}")
+
+    async def export(self):
+        await self.request("GET", "/segmentation/export", "/segmentation/export", params={"format": self.random.choice(["ndjson", "csv"])})
+
+    async def login(self):
+        response = await self.request("POST", "/login", "/login", json={"username": LOAD_TEST_USERNAME, "password": LOAD_TEST_PASSWORD})
+        if response is None or response.status_code != 200:
+            return
+        headers = {"Authorization": f"Bearer {response.json()['data']['access_token']}"}
+        await self.request("GET", "/me", "/me", headers=headers)
+        await self.request("POST", "/logout", "/logout", headers=headers)
+
+    async def user(self, deadline: float):
+        actions, weights = zip(*self.weights.items())
+        while time.perf_counter() < deadline:
+            await getattr(self, self.random.choices(actions, weights)[0])()
+
+    async def run(self, users: int, duration: float, warmup: float):
+        if warmup:
+            await asyncio.gather(*(self.user(time.perf_counter() + warmup) for _ in range(users)))
+            self.stats = {}
+
+        started = time.perf_counter()
+        await asyncio.gather(*(self.user(started + duration) for _ in range(users)))
+        elapsed = time.perf_counter() - started
+        return {endpoint: stats.summary(elapsed) for endpoint, stats in sorted(self.stats.items())}, elapsed
+
+
+def check_budgets(results: dict, budgets: dict):
+    violations = []
+    for endpoint, summary in results.items():
+        budget = budgets.get(endpoint, budgets.get("*", {}))
+        for metric, limit in budget.items():
+            if summary[metric] > limit:
+                violations.append(f"{endpoint}: {metric} {summary[metric]:.3f} exceeds {limit}")
+    return violations
+
+
+async def wait_until_ready(client: httpx.AsyncClient, timeout: float):
+    deadline = time.perf_counter() + timeout
+    while True:
+        try:
+            await client.get("/segmentation/scheduler")
+            return
+        except httpx.TransportError:
+            if time.perf_counter() > deadline:
+                raise SystemExit(f"Server at {client.base_url} did not come up within {timeout}s")
+            await asyncio.sleep(0.25)
+
+
+async def run(args, budgets: dict):
+    limits = httpx.Limits(max_connections=args.users, max_keepalive_connections=args.users)
+    async with httpx.AsyncClient(base_url=args.base_url, limits=limits, timeout=args.timeout) as client:
+        await wait_until_ready(client, args.startup_timeout)
+        load_test = LoadTest(client, args.scenario, args.seed)
+        await load_test.prepare()
+        return await load_test.run(args.users, args.duration, args.warmup)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Drive a running API with a realistic traffic mix and check per-endpoint latency budgets.")
+    parser.add_argument("--base-url", default="http://127.0.0.1:8000")
+    parser.add_argument("--scenario", choices=SCENARIOS, default="mixed")
+    parser.add_argument("--users", type=int, default=32, help="Concurrent virtual users, each sends its next request when the last one returns")
+    parser.add_argument("--duration", type=float, default=60, help="Measured seconds")
+    parser.add_argument("--warmup", type=float, default=5, help="Unmeasured seconds before the run")
+    parser.add_argument("--timeout", type=float, default=30, help="Per-request timeout in seconds")
+    parser.add_argument("--budgets", help="JSON file of endpoint budgets replacing the defaults")
+    parser.add_argument("--spawn", action="store_true", help="Start uvicorn app.main:app on the --base-url port for the run")
+    parser.add_argument("--startup-timeout", type=float, default=60)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", default="load-test.json", help="Where the JSON report is written")
+    args = parser.parse_args()
+
+    budgets = DEFAULT_BUDGETS
+    if args.budgets:
+        with open(args.budgets) as f:
+            budgets = json.load(f)
+
+    server = None
+    if args.spawn:
+        url = httpx.URL(args.base_url)
+        server = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "app.main:app", "--host", url.host, "--port", str(url.port or 80), "--log-level", "warning"],
+            # SQL echo goes to stdout
+            stdout=subprocess.DEVNULL,
+        )
+
+    try:
+        results, elapsed = asyncio.run(run(args, budgets))
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+    print(f"{'endpoint':<40} {'requests':>9} {'rps':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>7}")
+    for endpoint, summary in results.items():
+        print(
+            f"{endpoint:<40} {summary['requests']:>9} {summary['throughput_rps']:>8.1f} {summary['p50_ms']:>8.1f} "
+            f"{summary['p95_ms']:>8.1f} {summary['p99_ms']:>8.1f} {summary['error_rate']:>7.2%}"
+        )
+    print(f"{sum(summary['requests'] for summary in results.values()) / elapsed:.1f} requests/s overall")
+
+    untested = sorted(route_endpoints() - results.keys())
+    violations = check_budgets(results, budgets)
+    report = {
+        "created_at": datetime.now().isoformat(),
+        "scenario": args.scenario,
+        "users": args.users,
+        "duration": elapsed,
+        "budgets": budgets,
+        "endpoints": results,
+        "untested_endpoints": untested,
+        "violations": violations,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Report written to {args.output}")
+
+    if violations:
+        raise SystemExit("Budgets exceeded:\n" + "\n".join(violations))
+
+
+if __name__ == "__main__":
+    main()
+
+# ? Run with: `python -m benchmarks.load_test --scenario mixed --users 32 --duration 60`